@@ -0,0 +1,73 @@
+"""
+Index advice for the where clauses used to select sentences.
+
+> import advisor
+> advisor.advise('corpus = "GP" and temp_meaning = "future"', interactive=True)
+Full table scan: SCAN sentence
+Create an index on sentence(temp_meaning)? [y/N]
+
+Without `interactive`, the missing indexes are only logged (as warnings).
+"""
+import logging
+import re
+
+from peewee import BlobField, TextField
+
+from model import Sentence, init_sqlite_db
+
+
+def advise(where, model=Sentence, interactive=False):
+    """
+    Explain the query plan of a where clause, and report full table scans.
+
+    The columns in the clause that are not indexed are logged, or with
+    `interactive`, an index is offered for each of them. Return the
+    columns that were missing an index.
+    """
+    table = model._meta.table_name
+    plan = init_sqlite_db.execute_sql(
+        f'EXPLAIN QUERY PLAN SELECT "id" FROM "{table}" WHERE {where}'
+    ).fetchall()
+    scans = [row[-1] for row in plan if row[-1].startswith("SCAN")]
+    if not scans:
+        return []
+    missing = [
+        column for column in used_columns(where, model)
+        if column not in indexed_columns(table)
+    ]
+    if not interactive:
+        indexes = ", ".join(f"{table}({column})" for column in missing)
+        logging.warning(
+            f"Full table scan: {'; '.join(scans)}" + (f", consider an index on {indexes}" if missing else "")
+        )
+        return missing
+    print(f"Full table scan: {'; '.join(scans)}")
+    for column in missing:
+        if input(f"Create an index on {table}({column})? [y/N] ").strip().lower() == "y":
+            create_index(table, column)
+    return missing
+
+
+def used_columns(where, model=Sentence):
+    """The indexable columns of a model that are mentioned in a where clause."""
+    columns = []
+    for field in model._meta.sorted_fields:
+        # long texts are searched with like '%...%', which an index does not help
+        if field.primary_key or isinstance(field, (TextField, BlobField)):
+            continue
+        if re.search(rf"\b{field.column_name}\b", where):
+            columns.append(field.column_name)
+    return columns
+
+
+def indexed_columns(table):
+    """The columns that are first in an index (and so can be searched on their own)."""
+    return {index.columns[0] for index in init_sqlite_db.get_indexes(table) if index.columns}
+
+
+def create_index(table, column):
+    print(f"Creating index on {table}({column})...")
+    init_sqlite_db.execute_sql(
+        f'CREATE INDEX IF NOT EXISTS "{table}_{column}" ON "{table}" ("{column}")'
+    )
+    init_sqlite_db.execute_sql(f'ANALYZE "{table}"')
@@ -0,0 +1,279 @@
+"""
+Benchmarks of the sorter, on a synthetic corpus (see gencorpus.py).
+
+> import bench
+> bench.run(100000)
+
+or from the command line:
+    python bench.py 100000 [--save]
+
+Each step is run on a fresh data base in a temporary directory, and its
+throughput and peak memory are compared with the baseline in
+bench_baseline.json, if there is one. Use `save=True` to make the results
+the new baseline. Every step runs in a process of its own, and its memory
+is the peak resident size of that process (so it includes lxml and sqlite),
+and of the largest of its worker processes. The last step imports a
+corpus with one paragraph per sentence.
+"""
+import builtins
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import check
+import db
+import exporter
+import gencorpus
+import journal
+import lemmatize
+import model
+import nermodel
+from model import Sentence, init_sqlite_db
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+# Changes in throughput or memory above this fraction are reported.
+TOLERANCE = 0.2
+# Number of sentences labeled with scripted input in the inspect_update step.
+LABELED = 500
+
+
+def peak_mb(who):
+    """The peak resident size of this process (RUSAGE_SELF) or of its largest child, in MB."""
+    return round(resource.getrusage(who).ru_maxrss / 2 ** 10, 2)
+
+
+def measure(dbfile, name, size, processes, seed, queue):
+    """Run a step in this (fresh) process, and put its result in `queue`."""
+    model.ADVISE_INDEXES = False
+    init_sqlite_db.init(dbfile)
+    items, action = STEPS[name](size, processes, seed)
+    start = time.perf_counter()
+    with quiet():
+        action()
+    seconds = time.perf_counter() - start
+    init_sqlite_db.close()
+    queue.put({
+        "items": items,
+        "seconds": round(seconds, 4),
+        "rate": round(items / seconds, 1) if seconds else None,
+        "peak_mb": peak_mb(resource.RUSAGE_SELF),
+        "workers_mb": peak_mb(resource.RUSAGE_CHILDREN) or None,
+    })
+
+
+def run_step(dbfile, name, size, processes, seed):
+    """Run a step in a new process, so that its peak memory is its own."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(dbfile, name, size, processes, seed, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress output of the benchmarked functions."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+@contextlib.contextmanager
+def scripted_input(answers):
+    """Answer the prompts of the labeling functions from a list, and don't clear the screen."""
+    answers = iter(answers)
+    original_input, original_system = builtins.input, os.system
+    builtins.input = lambda *args: next(answers, "")
+    os.system = lambda command: 0
+    try:
+        yield
+    finally:
+        builtins.input, os.system = original_input, original_system
+
+
+def run(size=10000, baseline=BASELINE, save=False, processes=None, seed=0, workdir=None):
+    """
+    Run the benchmarks on a corpus of `size` sentences.
+
+    Return the results, as {step: {items, seconds, rate, peak_mb, workers_mb}}.
+    """
+    baseline = os.path.abspath(baseline)
+    cwd = os.getcwd()
+    advise = model.ADVISE_INDEXES
+    # not part of what is timed
+    model.ADVISE_INDEXES = False
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        os.chdir(tmp)
+        try:
+            results = run_steps(os.path.join(tmp, "bench.db"), size, processes, seed)
+        finally:
+            init_sqlite_db.close()
+            init_sqlite_db.init(os.path.join(cwd, model.DB_NAME))
+            os.chdir(cwd)
+            model.ADVISE_INDEXES = advise
+    report(results, load_baseline(baseline, size))
+    if save:
+        with open(baseline, "w") as fh:
+            json.dump({"size": size, "rss": True, "results": results}, fh, indent=2)
+        print(f"Saved the baseline to {baseline}")
+    return results
+
+
+def run_steps(dbfile, size, processes, seed):
+    gencorpus.generate("corpus", size, seed)
+    gencorpus.generate("paragraphs", size, seed, paragraphs=True)
+    init_sqlite_db.init(dbfile)
+    db.init_db()
+    init_sqlite_db.close()
+    results = {}
+    for name in STEPS:
+        if name == "check":
+            # the journal is not part of what is timed
+            init_sqlite_db.init(dbfile)
+            write_journal(size, seed)
+            init_sqlite_db.close()
+        results[name] = run_step(dbfile, name, size, processes, seed)
+    return results
+
+
+# The steps, in order. Each prepares what it needs and returns the number
+# of items and the function to measure.
+
+def import_corpus(size, processes, seed):
+    return size, lambda: db.import_data(
+        "corpus.txt", xml="corpus.xml", corpus="bench", processes=processes or 1
+    )
+
+
+def find_by_query(size, processes, seed):
+    def action():
+        len(db.find_by_query('corpus = "bench" and verb_lemma is null', create_todo=False))
+    return size, action
+
+
+def make_todolist(size, processes, seed):
+    with quiet():
+        selection = db.find_by_query('corpus = "bench" and verb_lemma is null', create_todo=False)
+    return size, lambda: db.make_todolist(selection, "bench")
+
+
+def select_by_xml(size, processes, seed):
+    return size, lambda: db.select_by_xml(Sentence.select(), {"deprel": "OO", "pos": "PN"})
+
+
+def add_lemmas(size, processes, seed):
+    return size, lambda: lemmatize.add_lemmas(processes=processes)
+
+
+def add_ne_info(size, processes, seed):
+    return size, lambda: nermodel.add_ne_info(processes=processes)
+
+
+def export(size, processes, seed):
+    return size, lambda: exporter.export_all(
+        Sentence.select(), {"out.txt": "text", "out.xml": "xml"}, processes=processes
+    )
+
+
+def check_journal(size, processes, seed):
+    return size, lambda: check.check([model.JOURNAL_FILE], full=True)
+
+
+def inspect_update(size, processes, seed):
+    labeled = min(size, LABELED)
+    sentences = list(Sentence.select().limit(labeled))
+    rng = random.Random(seed)
+    answers = [rng.choice(["future", "past", ""]) for _ in sentences]
+    def action():
+        with scripted_input(answers):
+            session = db.LabelSession("bench")
+            for sentence in sentences:
+                db.inspect_update(sentence, "temp_meaning", session=session)
+            session.close()
+    return labeled, action
+
+
+def import_paragraphs(size, processes, seed):
+    # into a data base of its own, the other steps are done
+    init_sqlite_db.init("paragraphs.db")
+    with quiet():
+        db.init_db()
+    return size, lambda: db.import_data(
+        "paragraphs.txt", xml="paragraphs.xml", corpus="bench", processes=processes or 1
+    )
+
+
+STEPS = {
+    "import_data": import_corpus,
+    "find_by_query": find_by_query,
+    "make_todolist": make_todolist,
+    "select_by_xml": select_by_xml,
+    "add_lemmas": add_lemmas,
+    "add_ne_info": add_ne_info,
+    "export": export,
+    "check": check_journal,
+    "inspect_update": inspect_update,
+    "import_paragraphs": import_paragraphs,
+}
+
+
+def write_journal(size, seed):
+    """A journal with one update for each sentence, that agrees with the data base."""
+    rng = random.Random(seed)
+    values = {}
+    with open(model.JOURNAL_FILE, "w", encoding="utf-8") as fh:
+        for sent_id in range(1, size + 1):
+            values[sent_id] = rng.choice(["future", "past", None])
+            fh.write(journal.entry(sent_id, "temp_meaning", None, values[sent_id], "bench"))
+    with quiet():
+        journal.replay()
+
+
+def load_baseline(path, size):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        baseline = json.load(fh)
+    results = baseline["results"]
+    if not baseline.get("rss"):
+        print("The baseline was made with the memory traced by tracemalloc, only rates are compared")
+        for result in results.values():
+            result["peak_mb"] = result["workers_mb"] = None
+    if baseline["size"] != size:
+        print(f"The baseline is for {baseline['size']} sentences, not {size}, only rates are compared")
+    return results
+
+
+def report(results, baseline=None):
+    """Print the results, and the changes since the baseline."""
+    print(f"{'step':<18}{'items':>9}{'seconds':>10}{'items/s':>12}{'peak MB':>10}{'workers MB':>12}  change")
+    for name, result in results.items():
+        changes = []
+        old = (baseline or {}).get(name)
+        if old and old["rate"] and result["rate"]:
+            speed = result["rate"] / old["rate"] - 1
+            if abs(speed) > TOLERANCE:
+                changes.append(f"{'faster' if speed > 0 else 'SLOWER'} {abs(speed):.0%}")
+        for key in ("peak_mb", "workers_mb"):
+            if old and old.get(key) and result[key] and old["items"] == result["items"]:
+                memory = result[key] / old[key] - 1
+                if memory > TOLERANCE:
+                    changes.append(f"MORE MEMORY {memory:.0%}" + (" (workers)" if key == "workers_mb" else ""))
+        print(
+            f"{name:<18}{result['items']:>9}{result['seconds']:>10.3f}{result['rate'] or 0:>12.0f}"
+            f"{result['peak_mb'] or 0:>10.2f}{result['workers_mb'] or 0:>12.2f}  {', '.join(changes)}"
+        )
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    run(int(args[0]) if args else 10000, save="--save" in sys.argv)
@@ -1,33 +1,122 @@
-import db
+"""
+Check that the data base agrees with the journal of label updates.
+
+> import check
+> check.check()
+
+Both the journal and the old log (.db.log) are checked, if they exist.
+Only the entries added since the last check are verified (the byte offset
+reached is saved next to each file), use `full=True` to check everything
+again.
+"""
+import collections
+import json
+import os
+
+import journal
 import model
-import re
+from peewee import chunked
+
+
+# A column of a sentence whose value differs from the log. The column of a
+# sentence that is not in the data base is None.
+Mismatch = collections.namedtuple("Mismatch", ["sentence", "column", "logged", "stored"])
+
+
+def check(logfiles=(model.LOG_FILE, model.JOURNAL_FILE), full=False, batch_size=999, report=None):
+    """
+    Check if the db and the log agrees on the sentence values.
+
+    The sentences are read `batch_size` at a time, with only the logged
+    columns. Return the mismatches, and write them as json lines to the
+    file `report`, if given.
+    """
+    if isinstance(logfiles, str):
+        logfiles = [logfiles]
+    status, bad, ends = {}, [], {}
+    for logfile in logfiles:
+        if not os.path.exists(logfile):
+            continue
+        offset = 0 if full else read_offset(logfile)
+        file_status, ends[logfile], file_bad = read_log(logfile, offset)
+        for sentid, values in file_status.items():
+            status.setdefault(sentid, {}).update(values)
+        bad.extend(file_bad)
+    for line in bad[:10]:
+        print(f'Bad line {line}')
+    if len(bad) > 10:
+        print(f'... and {len(bad) - 10} more bad lines')
+    mismatches = compare(status, batch_size)
+    for m in mismatches:
+        if m.column is None:
+            print(f'Sentence {m.sentence} lost?')
+        else:
+            print(f'Error? Sentence {m.sentence}, column {m.column}: {m.logged} != {m.stored}')
+    if report:
+        with open(report, "w") as fh:
+            for m in mismatches:
+                fh.write(json.dumps(m._asdict(), ensure_ascii=False, default=str))
+                fh.write("\n")
+    print(f'Checked {len(status)} sentences, found {len(mismatches)} mismatches')
+    for logfile, end in ends.items():
+        write_offset(logfile, end)
+    return mismatches
+
 
+def compare(status, batch_size=999):
+    """Compare the logged values of the sentences with the data base."""
+    fields = sorted({column for values in status.values() for column in values})
+    unknown = [column for column in fields if column not in model.Sentence._meta.fields]
+    for column in unknown:
+        print(f'Unknown column {column} in the log')
+    fields = [getattr(model.Sentence, column) for column in fields if column not in unknown]
+    mismatches = []
+    for ids in chunked(sorted(status), batch_size):
+        query = model.Sentence.select(model.Sentence.id, *fields).where(model.Sentence.id << ids)
+        stored = {row[0]: dict(zip(fields, row[1:])) for row in query.tuples()}
+        for sentid in ids:
+            if sentid not in stored:
+                mismatches.append(Mismatch(sentid, None, None, None))
+                continue
+            for field in fields:
+                if field.name not in status[sentid]:
+                    continue
+                val, curr = status[sentid][field.name], stored[sentid][field]
+                if curr != val:
+                    mismatches.append(Mismatch(sentid, field.name, val, curr))
+    return mismatches
 
-def check(logfile='.db.log'):
-    """Check if the db and the log agrees on the sentence values."""
-    status = create_status(logfile)
-    for sentid, values in status.items():
-        try:
-            sent = db.Sentence().get_by_id(sentid)
-        except:
-            print(f'Sentenec {sentid} lost?')
-        for key, val in values.items():
-            curr = str(model.get_field(sent, key))
-            if curr != val:
-                print(f'Error? Sentence {sentid}, column {key}: {val} != {curr}')
+
+def read_log(logfile, offset=0):
+    """
+    Read a journal (or the old log) from a byte offset.
+
+    Return the last logged value of each column of each sentence, the
+    offset after the last complete line, and the lines that could not be
+    read.
+    """
+    status = {}
+    bad = []
+    for item, offset in journal.read(logfile, offset, bad):
+        status.setdefault(item["id"], {})[item["column"]] = item["new"]
+    return status, offset, bad
 
 
 def create_status(logfile):
     """Create a dictionary with the current status, according to the log file."""
-    status = {}
-    for line in open(logfile):
-        pattern = 'update\({\s*(.*?):\s*(.*?)\s*}\).where\(.*==\s*(\d*)\)'
-        m = re.search(pattern, line)
-        if not m:
-            print(f'Bad line {line}')
-            continue
-        field, val, sentid = m.groups()
-        if sentid not in status:
-            status[sentid] = {}
-        status[sentid].update({field: val})
-    return status
+    return read_log(logfile)[0]
+
+
+def read_offset(logfile):
+    """The offset in the log reached by the last check (0 if the log has been replaced)."""
+    try:
+        with open(f"{logfile}.checked") as fh:
+            offset = int(fh.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+    return offset if offset <= os.path.getsize(logfile) else 0
+
+
+def write_offset(logfile, offset):
+    with open(f"{logfile}.checked", "w") as fh:
+        fh.write(f"{offset}\n")
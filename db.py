@@ -1,49 +1,513 @@
+import atexit
+import collections
 import logging
+import multiprocessing
 import os
+import queue
 import re
+import threading
 import time
+import uuid
 import lxml.etree as etree
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
+import model
 from model import *
+from selection import SearchSelection, Selection, TodoSelection
+import advisor
+import derived
+import exporter
+import journal
+from metrics import Metrics
 
 import pdb
 
 
 def init_db():
-    """Check if the tables exist, otherwise create them."""
-    for table in [Sentence, TodoList, NER]:
+    """Check if the tables exist, otherwise create them. Add missing columns and indexes."""
+    tables = [
+        Sentence, TodoList, NER, NERExtracted, NEStat, Token, VerbLemma,
+        AnnotationCheckpoint, AnnotationCache, AnnotationFailure, DerivedState,
+    ]
+    if AnnotationFailure.table_exists():
+        # failures were recorded again on every run before they were unique
+        init_sqlite_db.execute_sql(
+            "DELETE FROM annotationfailure WHERE id NOT IN "
+            "(SELECT MIN(id) FROM annotationfailure GROUP BY sentence_id, reason)"
+        )
+    for table in tables:
         if not table.table_exists():
             logging.info(f"Creating table '{table.__name__}'")
             table.create_table()
+        else:
+            migrate_table(table)
+    # covered by the (sentence, position) index
+    init_sqlite_db.execute_sql('DROP INDEX IF EXISTS "token_sentence_id"')
+    init_fts()
+    init_ne_stats()
+    derived.init_triggers()
+
+
+FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS sentence_fts_insert AFTER INSERT ON sentence BEGIN
+        INSERT INTO sentence_fts(rowid, text, verb_lemma) VALUES (new.id, new.text, new.verb_lemma);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS sentence_fts_delete AFTER DELETE ON sentence BEGIN
+        INSERT INTO sentence_fts(sentence_fts, rowid, text, verb_lemma)
+            VALUES ('delete', old.id, old.text, old.verb_lemma);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS sentence_fts_update AFTER UPDATE OF text, verb_lemma ON sentence BEGIN
+        INSERT INTO sentence_fts(sentence_fts, rowid, text, verb_lemma)
+            VALUES ('delete', old.id, old.text, old.verb_lemma);
+        INSERT INTO sentence_fts(rowid, text, verb_lemma) VALUES (new.id, new.text, new.verb_lemma);
+    END""",
+]
+
+
+def init_fts():
+    """
+    Create the full text index of the sentences (text and verb lemma).
+
+    It is kept up to date by triggers on the sentence table. An index
+    created for an existing data base is filled at once.
+    """
+    if "sentence_fts" in init_sqlite_db.get_tables():
+        return
+    logging.info("Creating full text index 'sentence_fts'")
+    with init_sqlite_db.atomic():
+        init_sqlite_db.execute_sql(
+            "CREATE VIRTUAL TABLE sentence_fts USING fts5("
+            "text, verb_lemma, content='sentence', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 0')"
+        )
+        for trigger in FTS_TRIGGERS:
+            init_sqlite_db.execute_sql(trigger)
+        init_sqlite_db.execute_sql("INSERT INTO sentence_fts(sentence_fts) VALUES ('rebuild')")
+
+
+# The NEStat row of a named entity kind (ne.ex, ne.type, ne.subtype) and a column value.
+NE_STAT_KEY = """"field" = '{field}' AND "value" IS {value}
+    AND "ex" IS {ne}.ex AND "type" IS {ne}.type AND "subtype" IS {ne}.subtype"""
+
+
+NE_STAT_TRIGGER = r"nestat_(.*)_(ner|nerextracted|sentence)_(insert|update|delete)$"
+
 
+def ne_stat_add(field, ne, sign):
+    """
+    Trigger statements adding (sign 1) or removing (sign -1) a ner row from the counts,
+    once for each sentence sharing it, by the value of that sentence.
+    """
+    sharing = f"""FROM nerextracted JOIN sentence ON sentence.id = nerextracted.sentence_id
+        WHERE nerextracted.source_id = {ne}.sentence_id"""
+    kind = f'"field" = \'{field}\' AND "ex" IS {ne}.ex AND "type" IS {ne}.type AND "subtype" IS {ne}.subtype'
+    of_value = f'{sharing} AND sentence."{field}" IS nestat.value'
+    statements = []
+    if sign > 0:
+        statements.append(f"""INSERT INTO nestat ("field", "value", ex, type, subtype, count)
+            SELECT DISTINCT '{field}', sentence."{field}", {ne}.ex, {ne}.type, {ne}.subtype, 0
+            {sharing} AND NOT EXISTS (
+                SELECT 1 FROM nestat WHERE {NE_STAT_KEY.format(field=field, value=f'sentence."{field}"', ne=ne)}
+            );""")
+    statements.append(f"""UPDATE nestat SET count = count + {sign} * (SELECT count(*) {of_value})
+        WHERE {kind} AND EXISTS (SELECT 1 {of_value});""")
+    if sign < 0:
+        statements.append(f"DELETE FROM nestat WHERE {kind} AND count <= 0;")
+    return "\n".join(statements)
+
+
+def ne_stat_move(field, source, value, sign):
+    """Trigger statements adding or removing all ner rows of the sentence `source` from the counts of `value`."""
+    of_source = f"ner.sentence_id = {source} AND ner.ex IS nestat.ex " \
+        "AND ner.type IS nestat.type AND ner.subtype IS nestat.subtype"
+    statements = []
+    if sign > 0:
+        statements.append(f"""INSERT INTO nestat ("field", "value", ex, type, subtype, count)
+            SELECT DISTINCT '{field}', {value}, ex, type, subtype, 0 FROM ner
+            WHERE ner.sentence_id = {source} AND NOT EXISTS (
+                SELECT 1 FROM nestat WHERE {NE_STAT_KEY.format(field=field, value=value, ne="ner")}
+            );""")
+    statements.append(f"""UPDATE nestat SET count = count + {sign} * (SELECT count(*) FROM ner WHERE {of_source})
+        WHERE "field" = '{field}' AND "value" IS {value} AND EXISTS (SELECT 1 FROM ner WHERE {of_source});""")
+    if sign < 0:
+        statements.append(f"""DELETE FROM nestat WHERE "field" = '{field}' AND "value" IS {value} AND count <= 0;""")
+    return "\n".join(statements)
+
+
+def ne_stat_triggers(field):
+    """
+    The triggers keeping the named entity counts of a sentence column up to date.
+
+    The named entities are counted for every sentence that shares them
+    (through nerextracted.source), by the value of that sentence.
+    """
+    value = f'(SELECT "{field}" FROM sentence WHERE id = {{0}}.sentence_id)'
+    has_sentence = "{0}.source_id IS NOT NULL AND EXISTS (SELECT 1 FROM sentence WHERE id = {0}.sentence_id)"
+    source = "(SELECT source_id FROM nerextracted WHERE sentence_id = {0}.id)"
+    has_nes = "EXISTS (SELECT 1 FROM nerextracted WHERE sentence_id = {0}.id AND source_id IS NOT NULL)"
+    return {
+        f"nestat_{field}_ner_insert": f"""AFTER INSERT ON ner BEGIN
+            {ne_stat_add(field, "new", 1)}
+        END""",
+        f"nestat_{field}_ner_delete": f"""AFTER DELETE ON ner BEGIN
+            {ne_stat_add(field, "old", -1)}
+        END""",
+        f"nestat_{field}_ner_update": f"""AFTER UPDATE OF ex, type, subtype, sentence_id ON ner BEGIN
+            {ne_stat_add(field, "old", -1)}
+            {ne_stat_add(field, "new", 1)}
+        END""",
+        f"nestat_{field}_nerextracted_insert": f"""AFTER INSERT ON nerextracted
+        WHEN {has_sentence.format("new")} BEGIN
+            {ne_stat_move(field, "new.source_id", value.format("new"), 1)}
+        END""",
+        f"nestat_{field}_nerextracted_delete": f"""AFTER DELETE ON nerextracted
+        WHEN {has_sentence.format("old")} BEGIN
+            {ne_stat_move(field, "old.source_id", value.format("old"), -1)}
+        END""",
+        f"nestat_{field}_nerextracted_update": f"""AFTER UPDATE OF sentence_id, source_id ON nerextracted BEGIN
+            {ne_stat_move(field, "old.source_id", value.format("old"), -1)}
+            {ne_stat_move(field, "new.source_id", value.format("new"), 1)}
+        END""",
+        f"nestat_{field}_sentence_update": f"""AFTER UPDATE OF "{field}" ON sentence
+        WHEN old."{field}" IS NOT new."{field}" AND {has_nes.format("new")} BEGIN
+            {ne_stat_move(field, source.format("new"), f'old."{field}"', -1)}
+            {ne_stat_move(field, source.format("new"), f'new."{field}"', 1)}
+        END""",
+        f"nestat_{field}_sentence_delete": f"""AFTER DELETE ON sentence
+        WHEN {has_nes.format("old")} BEGIN
+            {ne_stat_move(field, source.format("old"), f'old."{field}"', -1)}
+        END""",
+    }
+
+
+def init_ne_stats():
+    """
+    Set up the named entity counts (NEStat) for the columns in NE_STAT_COLUMNS.
 
-def import_data(txt, **kwargs):
+    The counts of a new column are computed from the ner table, and then
+    kept up to date by triggers. Columns that are no longer listed are
+    dropped.
+    """
+    triggers = {
+        name for name, in init_sqlite_db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'nestat_%'"
+        )
+    }
+    with init_sqlite_db.atomic():
+        for field in model.NE_STAT_COLUMNS:
+            wanted = ne_stat_triggers(field)
+            if set(wanted) <= triggers:
+                continue
+            logging.info(f"Counting named entities by '{field}'")
+            for name, trigger in wanted.items():
+                # replace the triggers of older versions
+                init_sqlite_db.execute_sql(f'DROP TRIGGER IF EXISTS "{name}"')
+                init_sqlite_db.execute_sql(f'CREATE TRIGGER "{name}" {trigger}')
+            NEStat.delete().where(NEStat.field == field).execute()
+            init_sqlite_db.execute_sql(f"""
+                INSERT INTO nestat ("field", "value", ex, type, subtype, count)
+                SELECT '{field}', sentence."{field}", ner.ex, ner.type, ner.subtype, count(*)
+                FROM nerextracted
+                JOIN sentence ON sentence.id = nerextracted.sentence_id
+                JOIN ner ON ner.sentence_id = nerextracted.source_id
+                GROUP BY 2, 3, 4, 5""")
+        fields = {re.match(NE_STAT_TRIGGER, name).group(1) for name in triggers}
+        for field in fields - set(model.NE_STAT_COLUMNS):
+            logging.info(f"Dropping the named entity counts by '{field}'")
+            for name in ne_stat_triggers(field):
+                init_sqlite_db.execute_sql(f'DROP TRIGGER IF EXISTS "{name}"')
+            NEStat.delete().where(NEStat.field == field).execute()
+
+
+def migrate_table(table):
+    """Add the columns and indexes of a model that are missing in its table."""
+    name = table._meta.table_name
+    columns = {column.name for column in init_sqlite_db.get_columns(name)}
+    migrator = SqliteMigrator(init_sqlite_db)
+    for field in table._meta.sorted_fields:
+        if field.column_name not in columns:
+            logging.info(f"Adding column '{field.column_name}' to '{name}'")
+            migrate(migrator.add_column(name, field.column_name, field))
+    table._schema.create_indexes(safe=True)
+
+
+def import_data(txt, batch_size=IMPORT_BATCH, processes=1, defer_indexes=True, **kwargs):
     """
     Import data from a txt file.
 
     Optionally add metadata (corpus, xml file or other field values.)
+    Both files are streamed, and the sentences are inserted `batch_size`
+    at a time, in one transaction per batch.
+    With `processes` > 1, the xml serialization and the creation of the
+    rows are spread over a pool of worker processes, while this process
+    does all the writing.
+    With `defer_indexes`, the secondary indexes of the token table are
+    dropped during the import and built again at the end, which is much
+    faster than keeping them up to date row by row. They are built for all
+    tokens though, so for a small import into a big data base, it may be
+    faster without.
+    """
+    print(f"Read {txt}")
+    start = time.time()
+    num = 0
+    if processes > 1:
+        rows = prepare_rows_parallel(txt, processes, **kwargs)
+    else:
+        rows = (
+            (prepare_row(line, parsed_xml=xml, **kwargs), tokens)
+            for line, xml, tokens in read_sentences(txt, kwargs.get("xml"))
+        )
+    if defer_indexes:
+        drop_token_indexes()
+    try:
+        for batch in chunked(rows, batch_size):
+            insert_sentences(batch)
+            num += len(batch)
+            print_progress(num, start)
+    finally:
+        if defer_indexes:
+            print("\nIndexing the tokens...", end="")
+            Token._schema.create_indexes(safe=True)
+    print(f"\nImported {num} sentences\n")
+
+
+def drop_token_indexes():
+    """Drop the indexes of the token table that are not needed while importing."""
+    for index in Token._meta.fields_to_index():
+        if not index._unique:
+            init_sqlite_db.execute_sql(f'DROP INDEX IF EXISTS "{index._name}"')
+
+
+def prepare_row(line, parsed_xml, **kwargs):
+    """Create the row of an imported sentence."""
+    return sentence_row(line, parsed_xml=parsed_xml, verb=get_verb(line), **kwargs)
+
+
+def prepare_rows(sentences, **kwargs):
+    """
+    Create the rows for a chunk of (line, raw xml) pairs. Run by the workers.
+
+    Return a (sentence row, token rows) pair for each line.
+    """
+    rows = []
+    for line, raw in sentences:
+        if raw:
+            elem = etree.fromstring(raw)
+            xml, tokens = etree.tostring(elem), token_rows(elem)
+        else:
+            xml, tokens = "<xml/>", []
+        rows.append((prepare_row(line, parsed_xml=xml, **kwargs), tokens))
+    return rows
+
+
+def prepare_rows_parallel(txt, processes, chunksize=1000, window=None, **kwargs):
+    """
+    Create the rows of the imported sentences in a pool of processes, keeping their order.
+
+    At most `window` (default 2 per process) chunks are given to the pool
+    before their rows are used, so that the memory use stays flat when the
+    writing falls behind.
+    """
+    xmlfile = kwargs.get("xml")
+    raw = split_sentence_xml(xmlfile) if xmlfile else None
+    def pairs():
+        with open(txt) as fp:
+            for line in fp:
+                xml = next(raw, None) if raw else b""
+                if xml is None:
+                    raise ValueError(f"{xmlfile} has fewer sentences than {txt}")
+                yield line, xml
+
+    window = window or 2 * processes
+    pending = collections.deque()
+    with multiprocessing.Pool(processes) as pool:
+        # the chunks are collected in order, so line num still matches sentence num
+        for chunk in chunked(pairs(), chunksize):
+            if len(pending) >= window:
+                yield from pending.popleft().get()
+            pending.append(pool.apply_async(prepare_rows, (chunk,), kwargs))
+        while pending:
+            yield from pending.popleft().get()
+
+
+def read_sentences(txt, xmlfile=None):
     """
+    Walk through the text file and the xml file together, line by sentence.
 
-    if "xml" in kwargs:
-        root = etree.parse(kwargs["xml"]).getroot()
-        sents = list(root.iterfind(".//sentence"))
+    Yield the line, the sentence xml and its token rows.
+    """
+    xmls = iter_sentence_xml(xmlfile) if xmlfile else None
+    with open(txt) as fp:
+        for line in fp:
+            xml, tokens = next(xmls, (None, None)) if xmls else ("<xml/>", [])
+            if xml is None:
+                raise ValueError(f"{xmlfile} has fewer sentences than {txt}")
+            yield line, xml, tokens
+
+
+def iter_sentence_xml(xmlfile):
+    """
+    Serialize the sentences of an xml file one at a time, freeing them as we go.
+
+    Yield the serialized sentence and its token rows.
+    """
+    for _, elem in etree.iterparse(xmlfile, tag="sentence"):
+        yield etree.tostring(elem, with_tail=False), token_rows(elem)
+        elem.clear()
+        # drop the already serialized siblings, and the finished siblings of
+        # the ancestors (eg. one paragraph per sentence), so that memory use stays flat
+        for node in [elem, *elem.iterancestors()]:
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+
+
+SENTENCE_RE = re.compile(rb"<sentence[\s>].*?</sentence>", re.S)
 
-    def get_sentence_xml(num):
-        if "xml" in kwargs:
-            return etree.tostring(sents[num])
-        return "<xml/>"
 
+def split_sentence_xml(xmlfile, blocksize=1 << 20):
+    """
+    Cut the raw <sentence> elements out of an xml file, without parsing it.
+
+    Much cheaper than a parse, so that one process can feed the parsing
+    workers. Relies on sentences not being nested, as in Sparv's output.
+    """
+    rest = b""
+    with open(xmlfile, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), b""):
+            rest += block
+            end = 0
+            for m in SENTENCE_RE.finditer(rest):
+                yield m.group()
+                end = m.end()
+            rest = rest[end:]
+
+
+def insert_sentences(sentences):
+    """Insert a batch of (sentence row, token rows) pairs within one transaction."""
+    with init_sqlite_db.atomic():
+        # the ids are given here, so that the tokens can refer to them
+        first = (Sentence.select(fn.MAX(Sentence.id)).scalar() or 0) + 1
+        rows, tokens = [], []
+        for sent_id, (row, words) in enumerate(sentences, first):
+            rows.append(dict(row, id=sent_id))
+            tokens.extend(dict(word, sentence=sent_id) for word in words)
+        bulk_insert(Sentence, rows)
+        bulk_insert(Token, tokens)
+
+
+def bulk_insert(table, rows, ignore=False):
+    """
+    Insert a list of row dictionaries with one prepared statement.
+
+    Same as `table.insert_many(rows)`, but without generating the sql for
+    every row, which is where most of the time goes for big batches.
+    With `ignore`, rows that break a uniqueness constraint are skipped.
+    """
+    if not rows:
+        return
+    fields = [table._meta.fields[name] for name in rows[0]]
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    params = ", ".join("?" for _ in fields)
+    insert = "INSERT OR IGNORE" if ignore else "INSERT"
+    sql = f'{insert} INTO "{table._meta.table_name}" ({columns}) VALUES ({params})'
+    # values that are stored as they are skip the (comparatively slow) db_value
+    fields = [(field.name, field.db_value, stored_type(field)) for field in fields]
+    values = [
+        [
+            row[name] if row[name] is None or type(row[name]) is plain else db_value(row[name])
+            for name, db_value, plain in fields
+        ]
+        for row in rows
+    ]
+    init_sqlite_db.cursor().executemany(sql, values)
+
+
+def stored_type(field):
+    """The python type whose values a field stores unchanged, if any."""
+    if isinstance(field, ForeignKeyField):
+        field = field.rel_field
+    if isinstance(field, (CharField, TextField)):
+        return str
+    if type(field) in (IntegerField, AutoField):
+        return int
+    return None
+
+
+def print_progress(num, start_time, action="Imported"):
+    """Print the number of handled sentences and the speed."""
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"\r{action} {num} sentences ({num / elapsed:.0f} rows/s)", end="")
+
+
+def token_rows(sent_xml):
+    """Create the Token rows (without sentence id) of a parsed sentence."""
+    rows = []
+    for num, word in enumerate(sent_xml.iterfind(".//w")):
+        row = {key: word.attrib.get(key) for key in token_attributes}
+        row.update(position=num, word=word.text)
+        rows.append(row)
+    return rows
+
+
+def update_tokens(sentences):
+    """
+    Rebuild the token index of some sentences, eg. after a re-annotation.
+
+    `sentences` is a list of (sentence id, xml) pairs.
+    """
+    rows = []
+    for sent_id, xml in sentences:
+        words = token_rows(etree.fromstring(xml)) if xml else []
+        rows.extend(dict(word, sentence=sent_id) for word in words)
+    with init_sqlite_db.atomic():
+        for ids in chunked([sent_id for sent_id, _ in sentences], 999):
+            Token.delete().where(Token.sentence << ids).execute()
+        bulk_insert(Token, rows)
+
+
+def compress_xml(batch_size=IMPORT_BATCH):
+    """
+    Compress the xml of sentences stored before the xml was compressed.
+
+    The data base file is vacuumed afterwards, to give back the space.
+    """
+    # compressed values start with the zlib header byte 0x78
+    query = (
+        Sentence.select(Sentence.id, Sentence.xml)
+        .where(Sentence.xml.is_null(False), fn.substr(Sentence.xml, 1, 1) != SQL("X'78'"))
+        .order_by(Sentence.id)
+    )
+    start = time.time()
+    num, last = 0, 0
+    while True:
+        batch = list(query.where(Sentence.id > last).limit(batch_size).tuples())
+        if not batch:
+            break
+        last = batch[-1][0]
+        with init_sqlite_db.atomic():
+            init_sqlite_db.cursor().executemany(
+                "UPDATE sentence SET xml = ? WHERE id = ?",
+                [(Sentence.xml.db_value(xml), sent_id) for sent_id, xml in batch],
+            )
+        num += len(batch)
+        print_progress(num, start, "Compressed")
+    print(f"\nCompressed the xml of {num} sentences")
+    init_sqlite_db.execute_sql("VACUUM")
+
+
+def index_tokens(selection=None, batch_size=IMPORT_BATCH):
+    """Fill the token index from the xml of the selected (default all) sentences."""
+    if selection is None:
+        selection = Sentence.select(Sentence.id, Sentence.xml).order_by(Sentence.id).iterator()
+    start = time.time()
     num = 0
-    print(f"Read {txt}")
-    for line in open(txt):
-        xml = get_sentence_xml(num)
-        verb = get_verb(line)
-        sent = parse_sentence(line, num, parsed_xml=xml, verb=verb, **kwargs)
-        sent.save()
-        num += 1
-    print(f"Imported {num} sentences\n")
+    for batch in chunked(selection, batch_size):
+        update_tokens([(sent.id, sent.xml) for sent in batch])
+        num += len(batch)
+        print_progress(num, start, "Indexed")
+    print(f"\nIndexed the tokens of {num} sentences")
 
 
 def get_verb(sentence):
@@ -56,49 +520,141 @@ def get_verb(sentence):
 
 def find_by_corpus(corpus):
     """Find all sentences in a corpus."""
-    selection = Sentence().select().where(Sentence.corpus == corpus)
-    print(f"Found {selection.count()} sentences")
+    selection = Selection(Sentence.corpus == corpus)
+    print(f"Found {len(selection)} sentences")
     return selection
 
 
-def find_by_query(query, create_todo=True):
+def find_by_lemma(lemma):
+    """Find all sentences where the focused verb has the lemma `lemma`."""
+    selection = Selection(
+        Sentence.id << VerbLemma.select(VerbLemma.sentence).where(VerbLemma.lemma == lemma)
+    )
+    print(f"Found {len(selection)} sentences")
+    return selection
+
+
+def set_verb_lemmas(lemmas):
+    """
+    Save the verb lemmas of sentences, in one transaction.
+
+    `lemmas` is a list of (sentence id, lemma string) pairs, where the lemma
+    string is as in Sentence.verb_lemma ("|finna|finnas|"). The VerbLemma
+    table is updated too.
+    """
+    with init_sqlite_db.atomic():
+        init_sqlite_db.cursor().executemany(
+            'UPDATE "sentence" SET "verb_lemma" = ? WHERE "id" = ?',
+            [(lemma, sent_id) for sent_id, lemma in lemmas],
+        )
+        index_verb_lemmas(lemmas)
+
+
+def index_verb_lemmas(lemmas):
+    """Update the VerbLemma table from (sentence id, lemma string) pairs."""
+    for ids in chunked([sent_id for sent_id, _ in lemmas], 999):
+        VerbLemma.delete().where(VerbLemma.sentence << ids).execute()
+    bulk_insert(VerbLemma, [
+        dict(sentence=sent_id, lemma=lemma)
+        for sent_id, lemmas_str in lemmas
+        for lemma in sorted(set((lemmas_str or "").split("|")) - {""})
+    ])
+
+
+def index_all_verb_lemmas(batch_size=IMPORT_BATCH):
+    """Fill the VerbLemma table from the verb_lemma column of all sentences."""
+    query = Sentence.select(Sentence.id, Sentence.verb_lemma).where(
+        Sentence.verb_lemma.is_null(False)
+    ).order_by(Sentence.id)
+    num = 0
+    for batch in chunked(query.tuples().iterator(), batch_size):
+        with init_sqlite_db.atomic():
+            index_verb_lemmas(batch)
+        num += len(batch)
+    print(f"Indexed the verb lemmas of {num} sentences")
+
+
+def search(match, limit=None):
+    """
+    Find sentences by full text search, best matches first.
+
+    `match` is an sqlite fts5 query, eg. `search('mormor')`, `search('"har sett"')`
+    or `search('verb_lemma: finna')`.
+    """
+    selection = SearchSelection(match, limit)
+    print(f"Found {len(selection)} sentences")
+    return selection
+
+
+def find_by_query(query, create_todo=True, todo=DEFAULT_TODO, advise=None):
     """
     Find all sentences by giving an sql where clause.
 
     Example: `find_by_query("corpus = 'familjeliv'")`
+    The sentences are counted in sql, and read page by page when used.
+    Full table scans are reported, as set by `advise` (default
+    `model.ADVISE_INDEXES`, see advisor.py).
     """
-    q = "select * from sentence where %s;" % query
-    selection = Sentence.raw(q)
+    advise_indexes(query, advise)
+    selection = Selection(query)
     print(f"found {len(selection)}")
     if create_todo:
         print(f"Creating todolist...")
-        make_todolist(selection)
+        make_todolist(selection, todo)
         print(f"Todolist created.")
     return selection
 
 
-def make_todolist(sentences):
-    TodoList.delete().execute()
-    for sent in sentences:
-        TodoList(sent=sent.id, checked=False).save()
+def advise_indexes(where, advise=None):
+    """Report the full table scans of a where clause, if `advise` (default `model.ADVISE_INDEXES`)."""
+    if advise is None:
+        advise = model.ADVISE_INDEXES
+    if advise:
+        advisor.advise(where, interactive=advise == "ask")
+
+
+def make_todolist(sentences, todo=DEFAULT_TODO):
+    """
+    Create (or replace) the todo list named `todo`.
+
+    For a Selection, the list is filled with one `insert ... select`.
+    """
+    with init_sqlite_db.atomic():
+        TodoList.delete().where(TodoList.name == todo).execute()
+        if isinstance(sentences, Selection):
+            query = sentences.query(Sentence.id, Value(todo), Value(False)).order_by(Sentence.id)
+            TodoList.insert_from(query, [TodoList.sent, TodoList.name, TodoList.checked]).execute()
+        else:
+            for chunk in chunked(sentences, IMPORT_BATCH):
+                bulk_insert(TodoList, [
+                    dict(sent=sent.id, name=todo, checked=False) for sent in chunk
+                ])
+
 
-def check_todolist():
-    todos = TodoList.select().where(TodoList.checked == 0).count()
+def check_todolist(todo=DEFAULT_TODO):
+    todos = TodoList.select().where(TodoList.name == todo, TodoList.checked == 0).count()
     print(f"You have {todos} sentences to do.")
     return todos
 
 
-def mark_as_done(sentence):
-    TodoList.update(checked=True).where(TodoList.sent==sentence.id).execute()
+def todo_lists():
+    """Print the todo lists and how far they have come."""
+    query = TodoList.select(
+        TodoList.name, fn.COUNT(TodoList.id), fn.SUM(TodoList.checked)
+    ).group_by(TodoList.name)
+    for name, total, checked in query.tuples():
+        print(f"{name}: {checked} of {total} done")
 
 
-def resume(field="", minutes=60):
-    todos = TodoList.select().where(TodoList.checked == 0)
-    label((t.sent for t in todos), field, minutes)
+def resume(field="", minutes=60, todo=DEFAULT_TODO):
+    label(TodoSelection(todo), field, minutes, todo=todo)
 
 
 def get_by_id(sentences):
     """Get new version of each sentence from db."""
+    if isinstance(sentences, Selection):
+        yield from sentences.pages()
+        return
     step = 999
     for x in range(0, len(sentences), step):
         ids = [s.id for s in sentences[x:x+step]]
@@ -109,8 +665,13 @@ def inspect(selection):
     label(selection, "", 1000)
 
 
-def label(selection, field, minutes=60):
-    """Go through selected sentences and show them, possible update them."""
+def label(selection, field, minutes=60, todo=DEFAULT_TODO, metrics=None):
+    """
+    Go through selected sentences and show them, possible update them.
+
+    With `metrics` (default `model.METRICS`), the session is timed (see metrics.py).
+    Return the journal session of the updates (see journal.revert).
+    """
     now = time.time()
     inspected, updated = 0, 0
     paused = False
@@ -118,48 +679,284 @@ def label(selection, field, minutes=60):
         fields = [field]
     else:
         fields = field
+    if metrics is None:
+        metrics = model.METRICS
+    session = LabelSession(todo, metrics=metrics)
+    session.metrics.start()
     last = None
-    for sent in selection:
+    try:
+        for sent in session.sentences(selection):
+            try:
+                inspected += 1
+                sent_updated = False
+                for field in fields:
+                    sent_updated = inspect_update(sent, field, last=last, session=session) or sent_updated
+                updated += int(sent_updated)
+                last = sent
+            except KeyboardInterrupt:
+                print("\nInterrupted.")
+                session.flush()
+                paused = True
+                break
+            except Exception as e:
+                log(f"Error in sentence {sent.id}, {sent.text}:")
+                log(e)
+                print(f"That did not work. Press any key to continue.")
+                input()
+            if check_time(minutes, now):
+                session.flush()
+                paused = True
+                break
+    finally:
         try:
-            inspected += 1
-            sent_updated = False
-            for field in fields:
-                sent_updated = inspect_update(sent, field, last=last) or sent_updated
-            updated += int(sent_updated)
-            last = sent
-        except KeyboardInterrupt:
-            print("\nInterrupted.")
-            paused = True
-            break
-        except Exception as e:
-            log(f"Error in sentence {sent.id}, {sent.text}:")
-            log(e)
-            print(f"That did not work. Press any key to continue.")
-            input()
-        if check_time(minutes, now):
-            paused = True
-            break
+            session.close()
+        finally:
+            session.metrics.stop()
     #if not paused and field:
-    if not check_todolist():
+    if not check_todolist(todo):
         print("No more sentences to sort! You are amazing!")
     print(f"Updated {updated} out of {inspected} inspected sentences")
+    if updated:
+        print(f"Journal session {session.id}, undo with journal.revert('{session.id}')")
+    session.metrics.report(
+        model.METRICS_FILE, todo=todo, fields=fields, inspected=inspected, updated=updated
+    )
+    return session.id
 
 
-def shortcuts(column):
-    """Create digit shortcuts for the values of a column in the Sentence table."""
+class LabelSession:
+    """
+    The state of a labeling session.
+
+    The shortcut values of each column are computed once, and extended when
+    new values are written. The sentences are read ahead in a background
+    thread, and are kept up to date here when they are updated, so that
+    they never have to be fetched again while labeling. The updates are
+    written behind, in groups (see `WriteBehind`), until the session is
+    closed (or used as a context manager). With `metrics`, the session is
+    timed (see metrics.py).
+    """
+
+    def __init__(self, todo=DEFAULT_TODO, prefetch=PREFETCH, metrics=False):
+        self.todo = todo
+        self.prefetch = prefetch
+        self.metrics = metrics if isinstance(metrics, Metrics) else Metrics(enabled=metrics)
+        # the session of the updates in the journal, to revert them with journal.revert
+        self.id = uuid.uuid4().hex
+        self.values = {}
+        self.stop = threading.Event()
+        self.queue = None
+        self._writer = None
+
+    @property
+    def writer(self):
+        """The write behind queue, started when first needed."""
+        if self._writer is None:
+            self._writer = WriteBehind(metrics=self.metrics, session=self.id)
+        return self._writer
+
+    def shortcuts(self, field):
+        """The digit shortcuts of a column."""
+        if field not in self.values:
+            self.values[field] = shortcut_values(field)
+        return dict(enumerate(self.values[field]))
+
+    def sentences(self, selection):
+        """Yield fresh versions of the selected sentences, read ahead in a background thread."""
+        self.queue = queue.Queue(maxsize=self.prefetch)
+        thread = threading.Thread(target=self.read_ahead, args=(selection,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def read_ahead(self, selection):
+        """Fill the queue with sentences, `prefetch` at a time. Run in the background."""
+        try:
+            for chunk in chunked(selection, self.prefetch):
+                if not isinstance(selection, Selection):
+                    chunk = refresh(chunk)
+                for sentence in chunk:
+                    if not self.put(sentence):
+                        return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+        finally:
+            if not init_sqlite_db.is_closed():
+                init_sqlite_db.close()
+
+    def put(self, item):
+        """Put an item in the queue, unless the session is closed."""
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write(self, sentence, field, value):
+        """Update a column of a sentence, both in the data base and in the session."""
+        column = get_field_id(field)
+        # keep the value as it would be read back from the data base
+        value = column.python_value(column.db_value(value))
+        self.writer.update(sentence.id, column, value, old=getattr(sentence, field))
+        setattr(sentence, field, value)
+        if field in self.values and value not in self.values[field]:
+            self.values[field] = sorted(self.values[field] + [value], key=shortcut_order)
+
+    def done(self, sentence):
+        """Mark a sentence as done in the todo list."""
+        self.writer.mark_done(sentence.id, self.todo)
+
+    def flush(self):
+        """Commit all queued updates."""
+        if self._writer:
+            self._writer.flush()
+
+    def close(self):
+        """Stop reading ahead and commit all queued updates."""
+        self.stop.set()
+        if self._writer:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    def sorter(val):
-        if val is None:
-            # put this very late, hopefully last...
-            return chr(10000)
-        return str(val)
 
+class WriteBehind:
+    """
+    Queue label updates and todo list completions, and commit them in groups.
+
+    Each update is appended to the journal at once, through a handle that
+    is kept open. The data base is updated in one transaction when
+    `max_pending` updates are queued, every `interval` seconds, when
+    flushed and at exit.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, max_pending=FLUSH_PENDING, logfile=JOURNAL_FILE,
+                 metrics=None, session=None):
+        self.max_pending = max_pending
+        self.metrics = metrics or Metrics(enabled=False)
+        self.updates = []
+        self.done = []
+        self.lock = threading.RLock()
+        self.log = journal.Journal(logfile, session)
+        self.stop = threading.Event()
+        self.timer = threading.Thread(target=self.flush_timer, args=(interval,), daemon=True)
+        self.timer.start()
+        atexit.register(self.close)
+
+    def update(self, sentence_id, column, value, old=None):
+        """Queue an update of a column."""
+        with self.lock:
+            self.updates.append((column, value, sentence_id))
+            with self.metrics.timer("log"):
+                self.log.write(sentence_id, column.name, old, value)
+        self.check()
+
+    def mark_done(self, sentence_id, todo=DEFAULT_TODO):
+        """Queue the completion of a sentence in a todo list."""
+        with self.lock:
+            self.done.append((todo, sentence_id))
+        self.check()
+
+    def check(self):
+        if len(self.updates) + len(self.done) >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        """Commit the queued updates in one transaction."""
+        with self.lock:
+            if not self.updates and not self.done:
+                return
+            updates, done = self.updates, self.done
+            self.updates, self.done = [], []
+            start = time.perf_counter()
+            try:
+                # through execute_sql, so that the statements are counted by the metrics
+                with init_sqlite_db.atomic():
+                    for column, value, sentence_id in updates:
+                        init_sqlite_db.execute_sql(
+                            f'UPDATE "sentence" SET "{column.column_name}" = ? WHERE "id" = ?',
+                            (column.db_value(value), sentence_id),
+                        )
+                    by_todo = {}
+                    for todo, sentence_id in done:
+                        by_todo.setdefault(todo, []).append(sentence_id)
+                    for todo, ids in by_todo.items():
+                        for part in chunked(ids, 999):
+                            init_sqlite_db.execute_sql(
+                                'UPDATE "todolist" SET "checked" = 1 WHERE "name" = ? '
+                                f'AND "sent_id" IN ({", ".join("?" for _ in part)})',
+                                [todo, *part],
+                            )
+            except Exception:
+                # keep them for the next try
+                self.updates, self.done = updates + self.updates, done + self.done
+                raise
+            self.log.sync()
+            self.metrics.add("flush", time.perf_counter() - start)
+
+    def flush_timer(self, interval):
+        """Flush every `interval` seconds. Run in the background."""
+        self.metrics.attribute()
+        while not self.stop.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log(f"Could not write the label updates: {e}")
+        if not init_sqlite_db.is_closed():
+            init_sqlite_db.close()
+
+    def close(self):
+        """Flush and stop."""
+        if self.stop.is_set():
+            return
+        self.stop.set()
+        self.flush()
+        self.log.close()
+        atexit.unregister(self.close)
+
+
+def refresh(sentences):
+    """Get new versions of a list of sentences, in the same order."""
+    fresh = {s.id: s for s in Sentence.select().where(Sentence.id << [s.id for s in sentences])}
+    return [fresh[s.id] for s in sentences if s.id in fresh]
+
+
+def shortcut_order(val):
+    """Sort key for the values of a column."""
+    if val is None:
+        # put this very late, hopefully last...
+        return chr(10000)
+    return str(val)
+
+
+def shortcut_values(column):
+    """The sorted, distinct values of a column in the Sentence table."""
     values = [
         get_field(val, column)
         for val in Sentence.select(get_field_id(column)).distinct()
     ]
-    values.sort(key=sorter)
-    return dict(zip(range(len(values)), values))
+    values.sort(key=shortcut_order)
+    return values
+
+
+def shortcuts(column):
+    """Create digit shortcuts for the values of a column in the Sentence table."""
+    return dict(enumerate(shortcut_values(column)))
 
 
 def print_shortcuts(shortcuts):
@@ -175,22 +972,25 @@ def print_shortcuts(shortcuts):
     print('\n')
 
 
-def inspect_update(sentence, field, last=None, updated=False):
+def inspect_update(sentence, field, last=None, updated=False, session=None):
     """Inspect a sentence, focusing on the column `field`, optionally update it."""
+    if session is None:
+        with LabelSession() as session:
+            return inspect_update(sentence, field, last, updated, session)
     shorts = {}
-    newval = print_sentence(sentence, field, shorts)
+    newval = print_sentence(sentence, field, shorts, session)
     if newval == BACK:
         if last:
-            updated = inspect_update(last, field)
-            newval = print_sentence(sentence, field, shorts)
+            updated = inspect_update(last, field, session=session)
+            newval = print_sentence(sentence, field, shorts, session)
         else:
             print("No preceeding sentence.")
             input()
-            return inspect_update(sentence, field, updated=updated, last=last)
-    mark_as_done(sentence)
+            return inspect_update(sentence, field, updated=updated, last=last, session=session)
+    session.done(sentence)
     if newval == INSPECT_KEY:
-        updated = deep_inspect(sentence)
-        return inspect_update(sentence, field, updated=updated, last=last)
+        updated = deep_inspect(sentence, session=session)
+        return inspect_update(sentence, field, updated=updated, last=last, session=session)
 
     else:
         if newval.strip().isdigit():
@@ -201,40 +1001,45 @@ def inspect_update(sentence, field, last=None, updated=False):
                 log(f"Invalid option {err}")
                 print(f"That did not work. Press any key to try again.")
                 input()
-                return inspect_update(sentence, field, last=last, updated=updated)
+                return inspect_update(sentence, field, last=last, updated=updated, session=session)
 
         if newval != "" and newval != get_field(sentence, field):
-            Sentence.update({get_field_id(field): convert(newval)}).where(
-                Sentence.id == sentence.id
-            ).execute()
-            log_update(
-                f"update({{ {get_field_id(field).name}: {convert(newval)} }}).where(Sentence.id == {sentence.id})"
-            )
+            session.write(sentence, field, convert(newval))
             return True
     return updated
 
 
-def print_sentence(sentence, field, shorts):
-    os.system("clear")
-    # get a new version of the sentence
-    sentence = Sentence().get_by_id(sentence.id)
-    print(sentence.id)
-    print(sentence.text)
-    if field:
-        shorts.update(shortcuts(field))
-        print(f"{field}: {get_field(sentence, field)}")
-        if field != "verb":
-            shorts.update(shortcuts(field))
-            print_shortcuts(shorts)
-        print(f"{field}: ", end="")
-    return input()
-
-
-def deep_inspect(sentence, msg="", updated=False):
+def print_sentence(sentence, field, shorts, session=None):
+    # the session keeps the sentence up to date
+    if session is None:
+        with LabelSession() as session:
+            return print_sentence(sentence, field, shorts, session)
+    metrics = session.metrics
+    metrics.displayed()
+    with metrics.timer("display"):
+        with metrics.timer("clear"):
+            os.system("clear")
+        print(sentence.id)
+        print(sentence.text)
+        if field:
+            with metrics.timer("shortcuts"):
+                shorts.update(session.shortcuts(field))
+            print(f"{field}: {get_field(sentence, field)}")
+            if field != "verb":
+                print_shortcuts(shorts)
+            print(f"{field}: ", end="", flush=True)
+    with metrics.timer("latency"):
+        return input()
+
+
+def deep_inspect(sentence, msg="", updated=False, session=None):
     """Make a deeper inspection of a sentence, and optionally update any column."""
-    os.system("clear")
-    # get a new version of the sentence
-    sentence = Sentence().get(Sentence.id == sentence.id)
+    # the session keeps the sentence up to date
+    if session is None:
+        with LabelSession() as session:
+            return deep_inspect(sentence, msg, updated, session)
+    with session.metrics.timer("clear"):
+        os.system("clear")
     print(msg, end=" ")
     print(sentence.id)
     print(sentence.text)
@@ -243,25 +1048,21 @@ def deep_inspect(sentence, msg="", updated=False):
         # Dont alllow updates of xml, text or id
         if field not in ["xml", "text", "id", "verb"]:
             print(f"{num}. {field}: {get_field(sentence, field)}")
-    action = input().strip()
+    with session.metrics.timer("latency"):
+        action = input().strip()
     if action == XML_KEY:
         show_xml(sentence)
-        return deep_inspect(sentence)
+        return deep_inspect(sentence, session=session)
     if action.isdigit():
         if int(action) >= len(fields):
-            return deep_inspect(sentence, "Invalid field, try again.")
+            return deep_inspect(sentence, "Invalid field, try again.", session=session)
         field = list(fields)[int(action)]
         val = get_field(sentence, field)
         print(f"{field}: ", end="")
         newval = input().strip()
         if newval and newval != val:
-            Sentence.update({get_field_id(field):convert(newval)}).where(
-                Sentence.id == sentence.id
-            ).execute()
-            log_update(
-                f"update({{ {get_field_id(field).name}: {convert(newval)} }}).where(Sentence.id == {sentence.id})"
-            )
-            return deep_inspect(sentence, msg="Updated!", updated=True)
+            session.write(sentence, field, convert(newval))
+            return deep_inspect(sentence, msg="Updated!", updated=True, session=session)
     return True
 
 
@@ -273,9 +1074,10 @@ def show_xml(sentence):
 
 
 def pretty_xml(sentence):
-    """Create pretty string of the xml of a sentence."""
+    """Create pretty string of the xml of a sentence (or of the xml itself)."""
+    xml = sentence.xml if isinstance(sentence, Sentence) else sentence
     return etree.tostring(
-        etree.fromstring(sentence.xml), encoding="unicode", pretty_print=True
+        etree.fromstring(xml), encoding="unicode", pretty_print=True
     )
 
 
@@ -294,21 +1096,12 @@ def export(sentences, filename, xmlfile=""):
 
     Print the text represention to a given file,
     possibly also print the xml representation.
+    For other formats, see `exporter.py`.
     """
-    fp = open(filename, "w")
+    files = {filename: "text"}
     if xmlfile:
-        xml_fp = open(xmlfile, "w")
-        xml_fp.write("<corpus><text><paragraph>")
-    num = 0
-    for sentence in sentences:
-        fp.write(sentence.text)
-        if xmlfile:
-            xml_fp.write(pretty_xml(sentence))
-        num += 1
-    print(f"Exported {num} sentences to file {filename}.")
-    if xmlfile:
-        xml_fp.write("</paragraph></text></corpus>")
-        print(f"Also printed xml file {xmlfile}.")
+        files[xmlfile] = "xml"
+    exporter.export_all(sentences, files)
 
 
 def select_by_xml(sentences, childword):
@@ -317,17 +1110,33 @@ def select_by_xml(sentences, childword):
 
     headword should be the deprel head of the childword.
     childword is a dictionary giving the necessary conditions for the other word.
+    The matching is done on the Token table, sentences that are not indexed
+    (see `index_tokens`), or conditions on attributes that are not in it, fall
+    back to parsing the xml.
+    For more complex structures, see `pattern.py`.
     """
     matches = []
     non_matches = []
-
-    for sentence in sentences:
-        pre, word = sentence.text.split("\t", 1)
-        position = len(pre.split())
-        sent_xml = etree.fromstring(sentence.xml)
-        for head in get_matching(position, sent_xml):
-            childword["dephead"] = head.attrib["ref"]
-            if get_matching(childword, sent_xml):
+    conditions = {key: val for key, val in childword.items() if key != "dephead"}
+    indexed = all(key == "word" or key in token_attributes for key in conditions)
+
+    for chunk in chunked(sentences, 999):
+        heads = {}
+        if indexed:
+            heads = indexed_heads([s.id for s in chunk], conditions)
+        load_xml([s for s in chunk if s.id not in heads])
+        for sentence in chunk:
+            position = verb_position(sentence.text)
+            if sentence.id in heads:
+                ntokens, found = heads[sentence.id]
+                if position >= ntokens:
+                    continue
+                ok = position in found
+            else:
+                ok = match_xml(sentence, position, conditions)
+                if ok is None:
+                    continue
+            if ok:
                 matches.append(sentence)
             else:
                 non_matches.append(sentence)
@@ -335,6 +1144,54 @@ def select_by_xml(sentences, childword):
     return matches, non_matches
 
 
+def indexed_heads(ids, conditions):
+    """
+    Look up the heads of words matching `conditions` in the Token table.
+
+    Return {sentence id: (number of tokens, positions of matching heads)}
+    for the sentences that are indexed.
+    """
+    heads = {
+        sent_id: (ntokens, set())
+        for sent_id, ntokens in Token.select(Token.sentence, fn.COUNT(Token.id))
+        .where(Token.sentence << ids)
+        .group_by(Token.sentence)
+        .tuples()
+    }
+    head, child = Token.alias(), Token.alias()
+    query = (
+        head.select(head.sentence, head.position)
+        .join(child, on=((child.sentence == head.sentence) & (child.dephead == head.ref)))
+        .where(head.sentence << ids, *[
+            getattr(child, key) == val for key, val in conditions.items()
+        ])
+        .distinct()
+        .tuples()
+    )
+    for sent_id, position in query:
+        heads[sent_id][1].add(position)
+    return heads
+
+
+def match_xml(sentence, position, conditions):
+    """Check a sentence by parsing its xml. None if there is no word at `position`."""
+    sent_xml = etree.fromstring(sentence.xml)
+    ok = None
+    for head in get_matching(position, sent_xml):
+        childword = dict(conditions, dephead=head.attrib["ref"])
+        ok = bool(get_matching(childword, sent_xml))
+    return ok
+
+
+def verb_position(text):
+    """Get the word index of the focused verb, which is surrounded by tabs."""
+    if re.search("\t(.*)\t", text):
+        pre, rest = text.split("\t", 1)
+        return len(pre.split())
+    # verb is in first position
+    return 0
+
+
 def get_matching(worddef, sent):
     """Find all words in a sentence matching the description."""
     matches = []
@@ -363,15 +1220,6 @@ def log(err):
         fh.write("\n")
 
 
-def log_update(update):
-    """Log an update to the data base."""
-    # note that a journal file is automatically written if the
-    # data base is opened in wal-mode.
-    with open(LOG_FILE, "a") as fh:
-        fh.write(update)
-        fh.write("\n")
-
-
 def check_time(minutes, start_time):
     """Check if it's time to take a break."""
     now = time.time()
@@ -384,13 +1232,5 @@ def check_time(minutes, start_time):
         
         
 def add_verbs():
-    for sent in Sentence.select():
-        try:
-            if not sent.verb:
-                verb = get_verb(sent.text)
-                Sentence.update({Sentence.verb: verb}).where(Sentence.id == sent.id).execute()
-            # print(f'added verb {verb} to {sent.id}')
-        except:
-            print(f"Did not update {sent.id}.")
-            print(f"{sent.text}")
-
+    """Set the verb of the sentences from their text (see `derived.compute`)."""
+    derived.compute("verb")
@@ -0,0 +1,306 @@
+"""
+Columns that are derived from the text and xml of the sentences.
+
+    verb            the focused verb, which is surrounded by tabs in the text
+    verb_position   the word index of the focused verb
+    token_count     the number of words (<w>) in the xml
+    verb_lemma      the lemma(s) of the focused verb, from the xml
+
+To compute all derived columns of the sentences that are not up to date:
+> import derived
+> derived.compute()
+
+or only one of them:
+> derived.compute('verb_lemma')
+
+The sentences that are done are saved in the derivedstate table, so an
+interrupted run continues where it stopped. When the text, xml (or another
+input) of a sentence changes, a trigger marks its derived columns as not
+up to date, and they are computed again by the next run. Values of the
+verb_lemma column that were there before it was first computed (eg. set
+by hand) are kept, until the inputs change. New columns are added to the
+sentence table by `db.init_db`.
+
+Derivations that only need the text are run as sqlite functions, in one
+UPDATE per batch. Those that parse the xml are run in a pool of worker
+processes.
+"""
+import multiprocessing
+import time
+from functools import partial
+
+import lxml.etree as etree
+from peewee import Value, chunked
+
+import db
+import lemmatize
+from model import IMPORT_BATCH, DerivedState, Sentence, init_sqlite_db, load_xml
+from selection import Selection
+
+
+class DerivationError(Exception):
+    """Raised by an extractor that cannot derive the value, the old value is kept."""
+
+
+class Derived:
+    """
+    A column of Sentence derived from other columns (`inputs`) by `extract`.
+
+    `extract` is called with the values of the inputs, and should be a
+    top level function, to be usable by the worker processes. With
+    `in_sql`, it is registered as an sqlite function instead. A failure
+    keeps the old value, and the value is None when an input is None.
+    Increase the `version` when the extractor changes, to compute the
+    column again for all sentences. `after` is called with the new
+    (sentence id, value) pairs of each batch, in the same transaction.
+    With `keep`, values that are set before the column is first computed
+    for a sentence are kept.
+    """
+
+    def __init__(self, column, inputs, extract, in_sql=False, version=1, after=None, keep=False):
+        self.column = column
+        self.inputs = inputs
+        self.extract = extract
+        self.in_sql = in_sql
+        self.version = version
+        self.after = after
+        self.keep = keep
+
+    def __repr__(self):
+        return f"<Derived {self.column} from {', '.join(self.inputs)}>"
+
+    def pending(self):
+        """The sentences whose value is not up to date."""
+        done = DerivedState.select(DerivedState.sentence).where(
+            DerivedState.column == self.column, DerivedState.version == self.version
+        )
+        names = [name for name in self.inputs if name != "xml"]
+        if self.keep and self.column not in names:
+            names.append(self.column)
+        return Selection(
+            Sentence.id.not_in(done),
+            fields=[Sentence.id] + [getattr(Sentence, name) for name in names],
+        )
+
+    def kept(self, batch):
+        """
+        The ids of the sentences of a batch whose value is kept.
+
+        Those are the ones (with `keep`) that have a value, but have never been computed.
+        """
+        if not self.keep:
+            return set()
+        have = [s.id for s in batch if getattr(s, self.column) is not None]
+        computed = set()
+        for part in chunked(have, 999):
+            query = DerivedState.select(DerivedState.sentence).where(
+                DerivedState.column == self.column, DerivedState.sentence << part
+            )
+            computed.update(sent_id for sent_id, in query.tuples())
+        return set(have) - computed
+
+
+def get_verb(text):
+    try:
+        return db.get_verb(text)
+    except AttributeError:
+        raise DerivationError(f"No verb found in {text!r}")
+
+
+def verb_position(text):
+    if "\t" not in text:
+        # no focused verb
+        return None
+    return db.verb_position(text)
+
+
+def token_count(xml):
+    if not xml:
+        return None
+    return len(etree.fromstring(xml).findall(".//w"))
+
+
+def verb_lemma(text, verb, xml):
+    _, lemma, problem = lemmatize.find_lemma(None, text, verb or "", xml)
+    if problem:
+        # without the "Problem! <id>," of lemmatize
+        raise DerivationError(problem.split(", ", 1)[-1])
+    return lemma
+
+
+def index_verb_lemmas(lemmas):
+    db.index_verb_lemmas(lemmas)
+
+
+# In the order they are computed, a column can be the input of a later one.
+DERIVED = {
+    derived.column: derived for derived in [
+        Derived("verb", ["text"], get_verb, in_sql=True),
+        Derived("verb_position", ["text"], verb_position, in_sql=True),
+        Derived("token_count", ["xml"], token_count),
+        Derived("verb_lemma", ["text", "verb", "xml"], verb_lemma, after=index_verb_lemmas, keep=True),
+    ]
+}
+
+
+# The version of outdated derived values, see `init_triggers`.
+OUTDATED = 0
+
+
+def init_triggers():
+    """
+    Create the triggers that mark derived columns as outdated when their inputs change.
+
+    The state is kept (with version OUTDATED) rather than deleted, so that
+    an outdated value is not mistaken for one that was never computed.
+    """
+    for derived in DERIVED.values():
+        # older data bases deleted the state
+        init_sqlite_db.execute_sql(f'DROP TRIGGER IF EXISTS "derived_{derived.column}_outdated"')
+        changed = " OR ".join(f'old."{name}" IS NOT new."{name}"' for name in derived.inputs)
+        columns = ", ".join(f'"{name}"' for name in derived.inputs)
+        init_sqlite_db.execute_sql(f"""
+            CREATE TRIGGER IF NOT EXISTS "derived_{derived.column}_changed"
+            AFTER UPDATE OF {columns} ON sentence WHEN {changed} BEGIN
+                UPDATE derivedstate SET version = {OUTDATED}
+                WHERE "column" = '{derived.column}' AND sentence_id = new.id;
+            END""")
+
+
+def compute(columns=None, processes=None, batch_size=IMPORT_BATCH, full=False):
+    """
+    Compute the derived `columns` (default all) of the sentences that are not up to date.
+
+    Each batch of `batch_size` sentences is saved in one transaction.
+    With `full`, all sentences are computed again, also the kept values.
+    """
+    if isinstance(columns, str):
+        columns = [columns]
+    for column in columns or DERIVED:
+        derived = DERIVED[column]
+        if full:
+            outdate(Sentence.select(Sentence.id), [column])
+        start = time.time()
+        if derived.in_sql:
+            num, failed = compute_in_sql(derived, batch_size, start)
+        else:
+            num, failed = compute_in_pool(derived, processes, batch_size, start)
+        print(f"\nComputed {column} for {num} sentences ({failed} failed)")
+
+
+def mark_done(derived, ids):
+    DerivedState.insert_many(
+        [dict(column=derived.column, sentence=sent_id, version=derived.version) for sent_id in ids]
+    ).on_conflict_replace().execute()
+
+
+def outdate(ids, columns=None):
+    """
+    Mark derived `columns` (default all) of some sentences as outdated, so that they are computed again.
+
+    `ids` is a list of ids or a query for them.
+    """
+    for column in columns or DERIVED:
+        query = (
+            Sentence.select(Sentence.id, Value(column), Value(OUTDATED))
+            .where(Sentence.id << ids)
+        )
+        DerivedState.insert_from(
+            query, [DerivedState.sentence, DerivedState.column, DerivedState.version]
+        ).on_conflict_replace().execute()
+
+
+def failure_report(problems, limit=10):
+    """Print the first `limit` problems, and the number of the rest."""
+    for problem in problems[:limit]:
+        print(problem)
+    if len(problems) > limit:
+        print(f"... and {len(problems) - limit} more")
+
+
+def compute_in_sql(derived, batch_size, start):
+    """Compute a column with one UPDATE per batch, calling `extract` as an sqlite function."""
+    name = f"derive_{derived.column}"
+    failed = []
+
+    def extract(old, *values):
+        if any(value is None for value in values):
+            return None
+        try:
+            return derived.extract(*values)
+        except DerivationError as e:
+            failed.append(str(e))
+            return old
+
+    init_sqlite_db.register_function(extract, name, len(derived.inputs) + 1, deterministic=True)
+    inputs = ", ".join(f'"{name}"' for name in derived.inputs)
+    column = Sentence._meta.fields[derived.column].column_name
+    num = 0
+    for batch in chunked(derived.pending(), batch_size):
+        kept = derived.kept(batch)
+        with init_sqlite_db.atomic():
+            for part in chunked([s.id for s in batch if s.id not in kept], 999):
+                init_sqlite_db.execute_sql(
+                    f'UPDATE "sentence" SET "{column}" = {name}("{column}", {inputs}) '
+                    f'WHERE "id" IN ({", ".join("?" for _ in part)})',
+                    part,
+                )
+            for part in chunked([s.id for s in batch], 999):
+                mark_done(derived, part)
+        num += len(batch)
+        db.print_progress(num, start, "Computed")
+    failure_report(failed)
+    return num, len(failed)
+
+
+def derive_rows(column, rows):
+    """Compute a column for a chunk of (id, *inputs). Run by the workers."""
+    extract = DERIVED[column].extract
+    results = []
+    for sent_id, *values in rows:
+        if any(value is None for value in values):
+            results.append((sent_id, None, None))
+            continue
+        try:
+            results.append((sent_id, extract(*values), None))
+        except DerivationError as e:
+            results.append((sent_id, None, f"{sent_id}: {e}"))
+        except Exception as e:
+            results.append((sent_id, None, f"{sent_id}: {e!r}"))
+    return results
+
+
+def compute_in_pool(derived, processes, batch_size, start):
+    """Compute a column in a pool of worker processes, saving each batch in one transaction."""
+    column = Sentence._meta.fields[derived.column].column_name
+    sql = f'UPDATE "sentence" SET "{column}" = ? WHERE "id" = ?'
+    num = 0
+    failed = []
+    with multiprocessing.Pool(processes) as pool:
+        for batch in chunked(derived.pending(), batch_size):
+            kept = derived.kept(batch)
+            todo = [s for s in batch if s.id not in kept]
+            if "xml" in derived.inputs:
+                load_xml(todo)
+            rows = [
+                (s.id, *[bytes(s.xml) if name == "xml" and s.xml else getattr(s, name)
+                         for name in derived.inputs])
+                for s in todo
+            ]
+            values = []
+            for results in pool.imap(partial(derive_rows, derived.column), chunked(rows, 500)):
+                for sent_id, value, problem in results:
+                    if problem:
+                        failed.append(problem)
+                    else:
+                        values.append((sent_id, value))
+            with init_sqlite_db.atomic():
+                init_sqlite_db.cursor().executemany(sql, [(value, sent_id) for sent_id, value in values])
+                if derived.after:
+                    derived.after(values)
+                for part in chunked([s.id for s in batch], 999):
+                    mark_done(derived, part)
+            num += len(batch)
+            db.print_progress(num, start, "Computed")
+    failure_report(failed)
+    return num, len(failed)
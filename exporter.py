@@ -0,0 +1,232 @@
+"""
+Export selections of sentences, in several formats.
+
+    text    the sentence text, one sentence per line
+    xml     the pretty printed sentence xml, in a <corpus> element
+    jsonl   one json object per sentence, with the label columns and the tokens
+    tsv     id, text and the label columns, with a header row
+    conllu  the tokens in CoNLL-U columns, with the sentence id, text and number of
+            the focused verb as comments
+
+> import exporter
+> exporter.export(sel, 'selection.conllu')
+> exporter.export_all(sel, {'selection.tsv': 'tsv', 'selection.xml': 'xml'}, columns=['tense'])
+
+The format is guessed from the file extension if not given. The sentences
+are read page by page, and the xml is pretty printed (or parsed, for the
+tokens of sentences that are not in the Token table) in a pool of worker
+processes, keeping the order.
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+
+import lxml.etree as etree
+from peewee import chunked
+
+import db
+from model import PAGE_SIZE, Token, load_xml, show_columns, token_attributes
+
+
+FORMATS = ["text", "xml", "jsonl", "tsv", "conllu"]
+EXTENSIONS = {".txt": "text", ".xml": "xml", ".jsonl": "jsonl", ".tsv": "tsv", ".conllu": "conllu"}
+# Size of the write buffer of each file.
+BUFFER_SIZE = 1024 * 1024
+
+
+def export(sentences, filename, format=None, columns=None, processes=None, page_size=PAGE_SIZE):
+    """Export a selection of sentences to one file."""
+    return export_all(sentences, {filename: format}, columns, processes, page_size)
+
+
+def export_all(sentences, files, columns=None, processes=None, page_size=PAGE_SIZE):
+    """
+    Export a selection of sentences to several files at once, reading it only once.
+
+    `files` maps file names to formats (None to guess from the extension).
+    `columns` are the label columns of the jsonl and tsv formats (default
+    all changeable columns). The xml is handled by `processes` worker
+    processes (default one per cpu). Sentences without xml (or tokens)
+    are left out of the xml and conllu files, and counted. Return the
+    number of sentences.
+    """
+    files = {filename: format or guess_format(filename) for filename, format in files.items()}
+    for format in files.values():
+        if format not in FORMATS:
+            raise ValueError(f"Unknown export format {format}, should be one of {FORMATS}")
+    columns = columns or show_columns()
+    formats = set(files.values())
+    num = 0
+    skipped = dict.fromkeys(files, 0)
+    with contextlib.ExitStack() as stack:
+        handles = {
+            filename: stack.enter_context(
+                open(filename, "w", encoding="utf-8", buffering=BUFFER_SIZE)
+            )
+            for filename in files
+        }
+        pool = None
+        if formats & {"xml", "jsonl", "conllu"}:
+            pool = stack.enter_context(multiprocessing.Pool(processes))
+        for filename, format in files.items():
+            HEADERS.get(format, lambda fh, columns: None)(handles[filename], columns)
+        for page in chunked(sentences, page_size):
+            pretty = render_xml(page, pool) if "xml" in formats else None
+            tokens = page_tokens(page, pool) if formats & {"jsonl", "conllu"} else None
+            for filename, format in files.items():
+                skipped[filename] += WRITERS[format](
+                    handles[filename], page, columns=columns, pretty=pretty, tokens=tokens
+                ) or 0
+            num += len(page)
+        for filename, format in files.items():
+            FOOTERS.get(format, lambda fh: None)(handles[filename])
+    for filename, format in files.items():
+        print(f"Exported {num - skipped[filename]} sentences to file {filename} ({format}).")
+        if skipped[filename]:
+            print(f"Left out {skipped[filename]} sentences without xml.")
+    return num
+
+
+def guess_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError(f"Give the format of {filename}, one of {FORMATS}")
+    return EXTENSIONS[extension]
+
+
+def render_xml(page, pool):
+    """The pretty printed xml of the sentences of a page (None for those without xml)."""
+    load_xml(page)
+    xmls = [bytes(s.xml) for s in page if s.xml]
+    rendered = pool.imap(db.pretty_xml, xmls, chunksize=max(1, len(xmls) // 64))
+    return [next(rendered) if s.xml else None for s in page]
+
+
+def page_tokens(page, pool):
+    """
+    The tokens (rows of the Token table) of the sentences of a page, by sentence id.
+
+    The xml of sentences that are not in the Token table is parsed instead.
+    """
+    tokens = {}
+    fields = [getattr(Token, name) for name in ["sentence", "position", "word"] + token_attributes]
+    for ids in chunked([s.id for s in page], 999):
+        query = Token.select(*fields).where(Token.sentence << ids).order_by(Token.sentence, Token.position)
+        for row in query.dicts():
+            tokens.setdefault(row.pop("sentence"), []).append(row)
+    missing = [s for s in page if s.id not in tokens]
+    load_xml(missing)
+    missing = [s for s in missing if s.xml]
+    parsed = pool.imap(parse_tokens, [bytes(s.xml) for s in missing], chunksize=16)
+    for sentence, rows in zip(missing, parsed):
+        tokens[sentence.id] = rows
+    return tokens
+
+
+def parse_tokens(xml):
+    """The token rows of a sentence xml. Run by the workers."""
+    return db.token_rows(etree.fromstring(xml))
+
+
+def text_of(sentence):
+    return sentence.text.rstrip("\n")
+
+
+def write_text(fh, page, **kwargs):
+    for sentence in page:
+        fh.write(text_of(sentence))
+        fh.write("\n")
+
+
+def write_xml(fh, page, pretty, **kwargs):
+    """Write the xml of a page. Return the number of sentences without xml."""
+    for xml in pretty:
+        if xml is not None:
+            fh.write(xml)
+    return pretty.count(None)
+
+
+def write_jsonl(fh, page, columns, tokens, **kwargs):
+    for sentence in page:
+        item = {"id": sentence.id, "text": text_of(sentence)}
+        item.update((column, getattr(sentence, column)) for column in columns)
+        item["tokens"] = tokens.get(sentence.id, [])
+        fh.write(json.dumps(item, ensure_ascii=False, default=str))
+        fh.write("\n")
+
+
+def tsv_value(value):
+    if value is None:
+        return ""
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def write_tsv(fh, page, columns, **kwargs):
+    for sentence in page:
+        values = [sentence.id, text_of(sentence)] + [getattr(sentence, column) for column in columns]
+        fh.write("\t".join(tsv_value(value) for value in values))
+        fh.write("\n")
+
+
+def conllu_value(value):
+    if value is None or value == "":
+        return "_"
+    return value.replace("\t", " ").replace("\n", " ")
+
+
+def conllu_lemma(lemma):
+    """The first lemma of a Sparv lemma set (|ha|hava| -> ha)."""
+    lemmas = [part for part in (lemma or "").split("|") if part]
+    return lemmas[0] if lemmas else None
+
+
+def write_conllu(fh, page, tokens, **kwargs):
+    """Write the tokens of a page. Return the number of sentences without tokens (or xml)."""
+    skipped = 0
+    for sentence in page:
+        words = tokens.get(sentence.id, [])
+        if not words:
+            skipped += 1
+            continue
+        # dependency heads are given as refs, CoNLL-U uses (1-based) word numbers
+        numbers = {word["ref"]: str(num) for num, word in enumerate(words, 1) if word["ref"]}
+        fh.write(f"# sent_id = {sentence.id}\n")
+        # the tabs around the focused verb are not part of the text, the verb is given by number
+        fh.write(f"# text = {' '.join(sentence.text.split())}\n")
+        focus = db.verb_position(sentence.text)
+        if focus < len(words) and sentence.verb and words[focus]["word"].lower() == sentence.verb.lower():
+            fh.write(f"# focus = {focus + 1}\n")
+        for num, word in enumerate(words, 1):
+            head = numbers.get(word["dephead"], "0") if word["dephead"] else "0"
+            fh.write("\t".join([
+                str(num),
+                conllu_value(word["word"]),
+                conllu_value(conllu_lemma(word["lemma"])),
+                "_",
+                conllu_value(word["msd"]),
+                "_",
+                head,
+                conllu_value(word["deprel"]),
+                "_",
+                "_",
+            ]))
+            fh.write("\n")
+        fh.write("\n")
+    return skipped
+
+
+WRITERS = {
+    "text": write_text,
+    "xml": write_xml,
+    "jsonl": write_jsonl,
+    "tsv": write_tsv,
+    "conllu": write_conllu,
+}
+HEADERS = {
+    "xml": lambda fh, columns: fh.write("<corpus><text><paragraph>\n"),
+    "tsv": lambda fh, columns: fh.write("\t".join(["id", "text"] + columns) + "\n"),
+}
+FOOTERS = {
+    "xml": lambda fh: fh.write("</paragraph></text></corpus>\n"),
+}
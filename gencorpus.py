@@ -0,0 +1,207 @@
+"""
+Generate a synthetic corpus, shaped like the Sparv output the sorter imports.
+
+> import gencorpus
+> gencorpus.generate('synthetic', 100000)
+
+writes synthetic.txt (one sentence per line, the focused verb surrounded
+by tabs) and synthetic.xml (the sentences with words, dependency trees and
+named entities), to be imported with
+> db.import_data('synthetic.txt', xml='synthetic.xml', corpus='synthetic')
+
+From the command line:
+    python gencorpus.py synthetic 100000 [seed] [--paragraphs]
+
+The sentences are random but realistic in shape: a subject, a finite verb
+(possibly an auxiliary with a supine or infinitive), objects, prepositional
+phrases and time adverbials, with place, person and time expressions marked
+as named entities.
+"""
+import random
+import sys
+
+
+NOUNS = [
+    ("hund", "hunden"), ("bil", "bilen"), ("bok", "boken"), ("stad", "staden"),
+    ("mat", "maten"), ("film", "filmen"), ("tidning", "tidningen"), ("dörr", "dörren"),
+    ("lärare", "läraren"), ("granne", "grannen"), ("fråga", "frågan"), ("plan", "planen"),
+]
+PRONOUNS = [("jag", "jag"), ("du", "du"), ("han", "han"), ("hon", "hon"), ("vi", "vi"), ("de", "de")]
+OBJECT_PRONOUNS = [("honom", "han"), ("henne", "hon"), ("dem", "de"), ("mig", "jag")]
+ADJECTIVES = ["stor", "gammal", "ny", "röd", "trevlig", "konstig"]
+# (lemma, present, preterite, supine, infinitive)
+VERBS = [
+    ("se", "ser", "såg", "sett", "se"), ("äta", "äter", "åt", "ätit", "äta"),
+    ("köpa", "köper", "köpte", "köpt", "köpa"), ("läsa", "läser", "läste", "läst", "läsa"),
+    ("finna", "finner", "fann", "funnit", "finna"), ("ta", "tar", "tog", "tagit", "ta"),
+    ("göra", "gör", "gjorde", "gjort", "göra"), ("skriva", "skriver", "skrev", "skrivit", "skriva"),
+]
+AUXILIARIES = [("ha", "har", "VB.PRS.AKT", "sup"), ("ha", "hade", "VB.PRT.AKT", "sup"),
+               ("skola", "ska", "VB.PRS.AKT", "inf"), ("vilja", "vill", "VB.PRS.AKT", "inf")]
+PREPOSITIONS = ["i", "på", "med", "från", "till", "utan"]
+PLACES = ["Göteborg", "Stockholm", "Malmö", "Umeå", "Norge", "Berlin"]
+NAMES = ["Anna", "Erik", "Sara", "Johan", "Karin", "Ali"]
+ADVERBS = ["inte", "ofta", "redan", "kanske", "nog", "aldrig"]
+# time expressions, as (words, subtype)
+TIMES = [(["igår"], "DAT"), (["i", "morgon"], "DAT"), (["på", "måndag"], "DAT"),
+         (["i", "höstas"], "DAT"), (["klockan", "tre"], "TIM"), (["varje", "vecka"], "SET")]
+
+
+class SentenceBuilder:
+    """The words of a sentence, with their heads given as word indexes."""
+
+    def __init__(self):
+        self.words = []
+        self.nes = []
+
+    def add(self, word, pos, msd, lemma, head, deprel):
+        self.words.append(dict(word=word, pos=pos, msd=msd, lemma=lemma, head=head, deprel=deprel))
+        return len(self.words) - 1
+
+    def ne(self, start, ex, type, subtype):
+        self.nes.append((start, len(self.words), ex, type, subtype))
+
+    def noun_phrase(self, rng, head, deprel):
+        """A noun, pronoun or name, attached to `head`."""
+        kind = rng.random()
+        if kind < 0.3:
+            pronoun, lemma = rng.choice(PRONOUNS if deprel == "SS" else OBJECT_PRONOUNS)
+            return self.add(pronoun, "PN", "PN.UTR.SIN.DEF.SUB", f"|{lemma}|", head, deprel)
+        if kind < 0.45:
+            name = rng.choice(NAMES)
+            start = len(self.words)
+            index = self.add(name, "PM", "PM.NOM", f"|{name}|", head, deprel)
+            self.ne(start, "ENAMEX", "PRS", "HUM")
+            return index
+        lemma, definite = rng.choice(NOUNS)
+        if rng.random() < 0.3:
+            adjective = rng.choice(ADJECTIVES)
+            adjective = self.add(adjective + "a", "JJ", "JJ.POS.UTR+NEU.SIN.DEF.NOM",
+                                 f"|{adjective}|", None, "AT")
+            index = self.add(definite, "NN", "NN.UTR.SIN.DEF.NOM", f"|{lemma}|", head, deprel)
+            self.words[adjective]["head"] = index
+            return index
+        return self.add(definite, "NN", "NN.UTR.SIN.DEF.NOM", f"|{lemma}|", head, deprel)
+
+    def prepositional_phrase(self, rng, head):
+        preposition = rng.choice(PREPOSITIONS)
+        preposition = self.add(preposition, "PP", "PP", f"|{preposition}|", head, "RA")
+        if rng.random() < 0.5:
+            place = rng.choice(PLACES)
+            start = len(self.words)
+            self.add(place, "PM", "PM.NOM", f"|{place}|", preposition, "PA")
+            self.ne(start, "ENAMEX", "LOC", "PPL")
+        else:
+            self.noun_phrase(rng, preposition, "PA")
+
+    def time(self, rng, head):
+        words, subtype = rng.choice(TIMES)
+        start = len(self.words)
+        pos = "AB" if len(words) == 1 else "PP"
+        first = self.add(words[0], pos, pos, f"|{words[0]}|", head, "TA")
+        for word in words[1:]:
+            self.add(word, "NN", "NN.UTR.SIN.IND.NOM", f"|{word}|", first, "PA")
+        self.ne(start, "TIMEX", "TME", subtype)
+
+
+def sentence(rng, min_words=5, max_words=30):
+    """
+    Create a random sentence.
+
+    Return the words (dictionaries with the Sparv attributes, with `head` as
+    a word index), the named entity spans (start, end, ex, type, subtype)
+    and the index of the focused verb.
+    """
+    builder = SentenceBuilder()
+    length = rng.randint(min_words, max_words)
+    subject = builder.noun_phrase(rng, None, "SS")
+    lemma, present, preterite, supine, infinitive = rng.choice(VERBS)
+    if rng.random() < 0.5:
+        aux_lemma, aux, aux_msd, form = rng.choice(AUXILIARIES)
+        root = builder.add(aux, "VB", aux_msd, f"|{aux_lemma}|", None, "ROOT")
+        if form == "sup":
+            verb = builder.add(supine, "VB", "VB.SUP.AKT", f"|{lemma}|", root, "VG")
+        else:
+            verb = builder.add(infinitive, "VB", "VB.INF.AKT", f"|{lemma}|", root, "VG")
+    else:
+        finite, msd = rng.choice([(present, "VB.PRS.AKT"), (preterite, "VB.PRT.AKT")])
+        root = verb = builder.add(finite, "VB", msd, f"|{lemma}|", None, "ROOT")
+    builder.words[subject]["head"] = root
+    if rng.random() < 0.2:
+        adverb = rng.choice(ADVERBS)
+        builder.add(adverb, "AB", "AB", f"|{adverb}|", verb, "NA")
+    if rng.random() < 0.8:
+        builder.noun_phrase(rng, verb, "OO")
+    if rng.random() < 0.3:
+        builder.time(rng, verb)
+    while len(builder.words) < length - 1:
+        if rng.random() < 0.7:
+            builder.prepositional_phrase(rng, verb)
+        else:
+            builder.time(rng, verb)
+    builder.add(".", "MAD", "MAD", "|", root, "IP")
+    return builder.words, builder.nes, verb
+
+
+def text_line(words, focus):
+    """The text of a sentence, with the focused verb surrounded by tabs."""
+    tokens = [word["word"] for word in words]
+    return " ".join(tokens[:focus]) + "\t" + tokens[focus] + "\t" + " ".join(tokens[focus + 1:])
+
+
+def sentence_xml(num, words, nes):
+    """The Sparv xml of a sentence."""
+    # the vocabulary has no characters that need escaping
+    starts = {start: (end, ex, type, subtype) for start, end, ex, type, subtype in nes}
+    out = [f'<sentence id="s{num}">']
+    end = None
+    for ref, word in enumerate(words, 1):
+        if ref - 1 == end:
+            out.append("</ne>")
+            end = None
+        if ref - 1 in starts:
+            end, ex, type, subtype = starts[ref - 1]
+            out.append(f'<ne ex="{ex}" type="{type}" subtype="{subtype}">')
+        dephead = "" if word["head"] is None else f' dephead="{word["head"] + 1}"'
+        out.append(
+            f'<w pos="{word["pos"]}" msd="{word["msd"]}" lemma="{word["lemma"]}" ref="{ref}"'
+            f'{dephead} deprel="{word["deprel"]}">{word["word"]}</w>'
+        )
+    if end is not None:
+        out.append("</ne>")
+    out.append("</sentence>\n")
+    return "".join(out)
+
+
+def generate(prefix, size, seed=0, paragraphs=False):
+    """
+    Write `size` sentences to prefix.txt and prefix.xml. Return the two file names.
+
+    The sentences are in one paragraph, or each in a paragraph of its own
+    if `paragraphs` is set (as in corpora of short posts).
+    """
+    rng = random.Random(seed)
+    txtfile, xmlfile = f"{prefix}.txt", f"{prefix}.xml"
+    with open(txtfile, "w", encoding="utf-8", buffering=1 << 20) as txt, \
+            open(xmlfile, "w", encoding="utf-8", buffering=1 << 20) as xml:
+        xml.write('<?xml version="1.0" encoding="UTF-8"?>\n<corpus><text>\n')
+        if not paragraphs:
+            xml.write("<paragraph>\n")
+        for num in range(size):
+            words, nes, focus = sentence(rng)
+            txt.write(text_line(words, focus))
+            txt.write("\n")
+            if paragraphs:
+                xml.write("<paragraph>")
+            xml.write(sentence_xml(num, words, nes))
+            if paragraphs:
+                xml.write("</paragraph>\n")
+        if not paragraphs:
+            xml.write("</paragraph>\n")
+        xml.write("</text></corpus>\n")
+    return txtfile, xmlfile
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    generate(args[0], int(args[1]), int(args[2]) if len(args) > 2 else 0, paragraphs="--paragraphs" in sys.argv)
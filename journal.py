@@ -0,0 +1,193 @@
+"""
+The journal of label updates, and replaying it.
+
+Each update is one json line:
+    {"ts": 1700000000.0, "session": "...", "id": 12, "column": "congruent", "old": null, "new": true}
+
+To recover the labels after a bad edit or a broken data base, import the
+data again (or use a backup) and replay the journal:
+> import journal
+> journal.replay()
+
+or only undo one labeling session (`db.label` prints and returns its
+session, `journal.sessions()` lists them all):
+> journal.revert('<session>')
+
+The old log (`.db.log`) can be replayed too, with `journal.replay(model.LOG_FILE)`.
+"""
+import json
+import os
+import re
+import time
+import uuid
+
+import model
+from peewee import chunked
+
+
+LEGACY_LINE = re.compile(r'update\({\s*(.*?):\s*(.*?)\s*}\).where\(.*==\s*(\d*)\)')
+
+
+class Journal:
+    """An open journal file, which the updates of one session are appended to."""
+
+    def __init__(self, path=model.JOURNAL_FILE, session=None):
+        self.session = session or uuid.uuid4().hex
+        self.fh = open(path, "a", encoding="utf-8")
+
+    def write(self, sentence_id, column, old, new):
+        self.fh.write(entry(sentence_id, column, old, new, self.session))
+        self.fh.flush()
+
+    def sync(self):
+        """Make sure that the written updates are on disk."""
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+def entry(sentence_id, column, old, new, session=None):
+    """A journal line."""
+    return json.dumps({
+        "ts": round(time.time(), 3),
+        "session": session,
+        "id": sentence_id,
+        "column": column,
+        "old": old,
+        "new": new,
+    }, ensure_ascii=False, default=str) + "\n"
+
+
+def read(path=model.JOURNAL_FILE, offset=0, bad=None):
+    """
+    Yield the entries of a journal from a byte offset, with the offset after each.
+
+    Lines of the old log format are read too (without time, session or old
+    value). Lines that cannot be read are added to the list `bad`, if given.
+    The last line is skipped if it is not complete.
+    """
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        for line in fh:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            item = parse(line.decode("utf-8", "replace").rstrip("\n"))
+            if item is None:
+                if bad is not None:
+                    bad.append(line.decode("utf-8", "replace").rstrip("\n"))
+                continue
+            yield item, offset
+
+
+def parse(line):
+    """Read a journal line, or a line of the old log. None if it is neither."""
+    if line.startswith("{"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+    m = LEGACY_LINE.search(line)
+    if not m:
+        return None
+    column, val, sentid = m.groups()
+    return {
+        "ts": None, "session": None, "id": int(sentid), "column": column,
+        "old": None, "new": legacy_value(column, val),
+    }
+
+
+def legacy_value(column, text):
+    """The value of a column from its string in the old log."""
+    if text == "None":
+        return None
+    field = model.Sentence._meta.fields.get(column)
+    if isinstance(field, model.BooleanField):
+        return {"True": True, "False": False}.get(text, text)
+    if isinstance(field, model.IntegerField):
+        try:
+            return int(text)
+        except ValueError:
+            return text
+    return text
+
+
+def final_values(entries, columns=None, since=None, until=None, session=None):
+    """The last value of each (sentence, column) in some journal entries."""
+    values = {}
+    for item, _ in entries:
+        if columns is not None and item["column"] not in columns:
+            continue
+        if session is not None and item["session"] != session:
+            continue
+        if item["ts"] is not None:
+            if since is not None and item["ts"] < since:
+                continue
+            if until is not None and item["ts"] > until:
+                continue
+        values[item["id"], item["column"]] = item["new"]
+    return values
+
+
+def replay(path=model.JOURNAL_FILE, columns=None, since=None, until=None, session=None,
+           batch_size=model.IMPORT_BATCH):
+    """
+    Apply the journal to the data base.
+
+    Each column of each sentence gets its last journaled value, optionally
+    only for some `columns`, one `session`, or the entries between the
+    timestamps `since` and `until`. The updates are made `batch_size` at a
+    time, in one transaction per batch. Return the number of updated values.
+    """
+    bad = []
+    values = final_values(read(path, bad=bad), columns, since, until, session)
+    if bad:
+        print(f"Skipped {len(bad)} bad lines, eg. {bad[0]}")
+    return apply(values, batch_size)
+
+
+def sessions(path=model.JOURNAL_FILE):
+    """
+    The sessions in a journal, in order, as a list of (session, first time, last time, updates).
+
+    The updates of the old log format have no session, and are left out.
+    """
+    found = {}
+    for item, _ in read(path):
+        if item["session"] is None:
+            continue
+        first, last, count = found.get(item["session"], (item["ts"], item["ts"], 0))
+        found[item["session"]] = (first, item["ts"], count + 1)
+    return [(session, *times) for session, times in found.items()]
+
+
+def revert(session, path=model.JOURNAL_FILE, batch_size=model.IMPORT_BATCH):
+    """Undo the updates of a session, by restoring the values from before its first update."""
+    values = {}
+    for item, _ in read(path):
+        if item["session"] == session:
+            values.setdefault((item["id"], item["column"]), item["old"])
+    return apply(values, batch_size)
+
+
+def apply(values, batch_size=model.IMPORT_BATCH):
+    """Write a dictionary of (sentence id, column): value to the data base."""
+    by_column = {}
+    for (sentence_id, column), value in values.items():
+        by_column.setdefault(column, []).append((sentence_id, value))
+    num = 0
+    for column, updates in by_column.items():
+        field = model.Sentence._meta.fields.get(column)
+        if field is None or column in ("id", "text", "xml"):
+            print(f"Skipping the column {column}")
+            continue
+        sql = f'UPDATE "sentence" SET "{field.column_name}" = ? WHERE "id" = ?'
+        for batch in chunked(updates, batch_size):
+            with model.init_sqlite_db.atomic():
+                model.init_sqlite_db.cursor().executemany(
+                    sql, [(field.db_value(value), sentence_id) for sentence_id, value in batch]
+                )
+            num += len(batch)
+    print(f"Replayed {num} values")
+    return num
@@ -1,53 +1,101 @@
 import db
+import derived
 import xml.etree.ElementTree as ET
+import multiprocessing
 import re
+import time
 import pdb
+from model import IMPORT_BATCH, load_xml
+from peewee import chunked
 
-# First, create the column.
-# db.Sentence.raw('ALTER TABLE sentence ADD lemma varchar;').execute()
+# The verb_lemma column is added by db.init_db(), and kept up to date for
+# all sentences by derived.compute('verb_lemma').
 
-# To search
-# SELECT lemma from "sentence" where lemma like ('%|finna|%')
+# To search, use the indexed VerbLemma table:
+# db.find_by_lemma('finna')
 
 def add_lemma(sent):
-    if re.search('\t(.*)\t', sent.text):
-        pre, rest = sent.text.split('\t', 1)
-        index = len(pre.split())
-    else:  # verb is in first position
-        index = 0
-    sxml = ET.fromstring(sent.xml)
-    wxml = sxml.findall(".//w")[index]
-    if wxml.text.lower() == sent.verb.lower():
-        sent.verb_lemma = wxml.attrib.get('lemma')
-        sent.save()
+    sent_id, lemma, problem = find_lemma(sent.id, sent.text, sent.verb, sent.xml)
+    if problem:
+        print(problem)
     else:
-        retry(sent, index, sxml, sent.verb)
+        sent.verb_lemma = lemma
+        db.set_verb_lemmas([(sent.id, lemma)])
 
 
-def retry(sent, index, sxml, verb):
+def find_lemma(sent_id, text, verb, xml):
+    """
+    Find the lemma of the focused verb of a sentence.
+
+    Return (id, lemma, None), or (id, None, problem) if the verb is not found.
+    """
+    index = db.verb_position(text)
+    words = ET.fromstring(xml).findall(".//w")
+    if index < len(words) and (words[index].text or "").lower() == verb.lower():
+        return sent_id, words[index].attrib.get('lemma'), None
+    return retry(sent_id, index, words, verb)
+
+
+def retry(sent_id, index, words, verb):
     matches = 0
-    for wxml in sxml.findall(".//w")[max(0, index-5):index+5]:
+    lemma = None
+    for wxml in words[max(0, index-5):index+5]:
         if wxml.text == verb:
-            sent.verb_lemma = wxml.attrib.get('lemma')
+            lemma = wxml.attrib.get('lemma')
             matches += 1
     if matches != 1:
-        print(f'Problem! {sent.id}, {matches} matching words found')
-    else:
-        sent.save()
+        return sent_id, None, f'Problem! {sent_id}, {matches} matching words found'
+    return sent_id, lemma, None
+
+
+def find_lemmas(sentences):
+    """Find the lemmas of a chunk of (id, text, verb, xml). Run by the workers."""
+    return [find_lemma(*sentence) for sentence in sentences]
 
 
+def add_lemmas(selection=None, processes=None, batch_size=IMPORT_BATCH):
+    """
+    Add the verb lemma of the selected sentences (default all).
 
-def add_lemmas(selection):
-    for sent in selection:
-        add_lemma(sent)
+    Sentences that already have a lemma are skipped. The xml is parsed in
+    a pool of `processes` processes (default one per cpu), and the lemmas
+    are saved in one transaction per `batch_size` sentences. For all
+    sentences, this is `derived.compute('verb_lemma')`, which also redoes
+    the sentences whose text or xml has changed since their lemma was
+    computed (but keeps lemmas that were set otherwise, eg. by hand).
+    """
+    if selection is None:
+        derived.compute("verb_lemma", processes, batch_size)
+        return
+    todo = (
+        sent for sent in selection
+        if sent.verb_lemma is None and sent.verb
+    )
+    start = time.time()
+    num = 0
+    with multiprocessing.Pool(processes) as pool:
+        for batch in chunked(todo, batch_size):
+            load_xml(batch)
+            rows = [(s.id, s.text, s.verb, s.xml) for s in batch if s.xml]
+            lemmas = []
+            for results in pool.imap(find_lemmas, chunked(rows, 500)):
+                for sent_id, lemma, problem in results:
+                    if problem:
+                        print(problem)
+                    else:
+                        lemmas.append((sent_id, lemma))
+            db.set_verb_lemmas(lemmas)
+            num += len(batch)
+            db.print_progress(num, start, "Lemmatized")
+    print(f"\nLemmatized {num} sentences")
 
 
 def add_manual(filep):
+    lemmas = []
     for line in open(filep):
         m = re.match("id='(\d*)'.*='(.*)'", line)
         if not m:
             continue
         print(f'Add lemma {m.group(2)} to id {m.group(1)}')
-        s = db.Sentence().get_by_id(m.group(1))
-        s.verb_lemma = f'|{m.group(2)}|'
-        s.save()
+        lemmas.append((int(m.group(1)), f'|{m.group(2)}|'))
+    db.set_verb_lemmas(lemmas)
@@ -0,0 +1,156 @@
+"""
+Timings of labeling sessions, to see where the time goes.
+
+> db.label(sel, 'temp_meaning', metrics=True)
+
+prints a summary after the session, with percentiles per displayed sentence
+of the sql statements (number and time) run while labeling, the time it
+took to show the sentence (and of that, clearing the screen and finding
+the shortcuts), the time until the annotator answered, and the time spent
+writing the journal and committing the updates. A slow data base shows in
+the sql and commit times, a slow terminal in the clear and display times.
+With `model.METRICS_FILE` set, the summary is also appended to that file,
+as a json line.
+"""
+import contextlib
+import json
+import math
+import threading
+import time
+
+from model import init_sqlite_db
+
+
+# Rows of the summary: (name, unit, description)
+ROWS = [
+    ("sql", "", "sql statements per sentence"),
+    ("sql_time", "ms", "sql time per sentence"),
+    ("display", "ms", "showing the sentence"),
+    ("clear", "ms", "  of which clearing the screen"),
+    ("shortcuts", "ms", "  of which finding the shortcuts"),
+    ("latency", "ms", "waiting for the annotator"),
+    ("log", "ms", "writing the journal"),
+    ("flush", "ms", "committing the updates"),
+]
+PERCENTILES = [50, 90, 99]
+
+
+class Metrics:
+    """
+    Samples of the timings of a labeling session.
+
+    Metrics that are not `enabled` record nothing, so that the labeling
+    code can use them unconditionally. The sql statements are counted by
+    wrapping `init_sqlite_db.execute_sql` between `start` and `stop`; those
+    run by the labeling thread and by the threads that call `attribute`
+    (the timed flushes of the updates) go to the sentence being shown, the
+    rest (reading ahead) are only counted.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.samples = {name: [] for name, _, _ in ROWS}
+        self.sql, self.sql_time = 0, 0.0
+        self.background_sql = 0
+        self.showing = False
+        self.thread = None
+        self.threads = set()
+        self._execute_sql = None
+
+    def start(self):
+        """Start counting the sql statements."""
+        if not self.enabled or self._execute_sql:
+            return
+        self.thread = threading.get_ident()
+        self._execute_sql = execute_sql = init_sqlite_db.execute_sql
+
+        def counted(*args, **kwargs):
+            thread = threading.get_ident()
+            if thread != self.thread and thread not in self.threads:
+                self.background_sql += 1
+                return execute_sql(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return execute_sql(*args, **kwargs)
+            finally:
+                self.sql += 1
+                self.sql_time += time.perf_counter() - start
+
+        init_sqlite_db.execute_sql = counted
+
+    def stop(self):
+        """Stop counting the sql statements, and close the last sentence."""
+        if self._execute_sql:
+            del init_sqlite_db.execute_sql
+            self._execute_sql = None
+            self.displayed(another=False)
+
+    def attribute(self):
+        """Count the sql statements of the calling thread as work for the sentence shown."""
+        self.threads.add(threading.get_ident())
+
+    def add(self, name, value):
+        if self.enabled:
+            self.samples[name].append(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time a block, as a sample of `name`."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def displayed(self, another=True):
+        """A new sentence is shown: save the sql statements run since the last one."""
+        if self.showing:
+            self.add("sql", self.sql)
+            self.add("sql_time", self.sql_time)
+        self.sql, self.sql_time = 0, 0.0
+        self.showing = another and self.enabled
+
+    def summary(self):
+        """The percentiles (and max and count) of each metric, in the units of ROWS."""
+        summary = {}
+        for name, unit, _ in ROWS:
+            values = sorted(self.samples[name])
+            if not values:
+                continue
+            scale = 1000 if unit == "ms" else 1
+            summary[name] = dict(
+                {f"p{p}": round(percentile(values, p) * scale, 2) for p in PERCENTILES},
+                max=round(values[-1] * scale, 2),
+                n=len(values),
+            )
+        summary["background_sql"] = self.background_sql
+        return summary
+
+    def report(self, filename=None, **info):
+        """Print the summary, and append it (with `info`) to the file `filename`, if given."""
+        if not self.enabled:
+            return
+        summary = self.summary()
+        labels = {name: description + (f" ({unit})" if unit else "") for name, unit, description in ROWS}
+        width = max(len(label) for label in labels.values()) + 2
+        print(f"{'':<{width}}" + "".join(f"{f'p{p}':>9}" for p in PERCENTILES) + f"{'max':>9}{'n':>7}")
+        for name, label in labels.items():
+            if name not in summary:
+                continue
+            row = summary[name]
+            values = "".join(f"{row[f'p{p}']:>9}" for p in PERCENTILES)
+            print(f"{label:<{width}}{values}{row['max']:>9}{row['n']:>7}")
+        print(f"sql statements reading ahead: {self.background_sql}")
+        if filename:
+            with open(filename, "a") as fh:
+                fh.write(json.dumps(dict(info, ts=round(time.time(), 3), metrics=summary)))
+                fh.write("\n")
+
+
+def percentile(values, p):
+    """The nearest rank percentile of a sorted list."""
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
@@ -1,4 +1,6 @@
 """Configuration for the database and the sorter."""
+import zlib
+
 from peewee import (
     Model,
     SqliteDatabase,
@@ -6,7 +8,11 @@ from peewee import (
     BlobField,
     CharField,
     BooleanField,
+    BareField,
     ForeignKeyField,
+    IntegerField,
+    FieldAccessor,
+    chunked,
 )
 
 
@@ -16,6 +22,29 @@ XML_KEY = "x"
 DB_NAME = "test.db"
 ERR_FILE = ".db.err"
 LOG_FILE = ".db.log"
+# Json lines journal of the label updates (see journal.py), replaces LOG_FILE.
+JOURNAL_FILE = ".db.journal"
+# Number of sentences written per transaction when importing.
+IMPORT_BATCH = 10000
+# Name of the todo list used when none is given.
+DEFAULT_TODO = "default"
+# Number of sentences read at a time when going through a selection.
+PAGE_SIZE = 1000
+# Number of sentences read ahead while labeling.
+PREFETCH = 50
+# Label updates are committed in groups, after this many seconds or updates.
+FLUSH_INTERVAL = 2.0
+FLUSH_PENDING = 20
+# Explain the where clauses of selections, and log the scanned columns without an index
+# (see advisor.py). With "ask", creating the indexes is offered instead.
+ADVISE_INDEXES = True
+# Time labeling sessions (see metrics.py), and append the summaries to this file (if not None).
+METRICS = False
+METRICS_FILE = None
+# zlib level used for the sentence xml.
+XML_COMPRESSION = 6
+# Sentence columns that the named entity counts are kept up to date for (see NEStat).
+NE_STAT_COLUMNS = ["corpus", "congruent", "tense"]
 
 
 # SQLite database using WAL journal mode and 64MB cache.
@@ -31,32 +60,92 @@ class BaseModel(Model):
         database = init_sqlite_db
 
 
+class LazyXMLAccessor(FieldAccessor):
+    """Fetch the xml of a sentence the first time it is used, if it was not selected."""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None and self.name not in instance.__data__ and instance._pk is not None:
+            primary_key = self.model._meta.primary_key
+            query = self.model.select(self.field).where(primary_key == instance._pk)
+            instance.__data__[self.name] = query.tuples().get()[0]
+        return super().__get__(instance, instance_type)
+
+
+class CompressedXMLField(BlobField):
+    """
+    Xml stored zlib compressed, and decompressed when read.
+
+    Uncompressed values, from data bases created before compression, are
+    read as they are. See `db.compress_xml` for compressing them.
+    """
+
+    accessor_class = LazyXMLAccessor
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return super().db_value(zlib.compress(value, XML_COMPRESSION))
+
+    def python_value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if value.lstrip()[:1] == b"<":
+            return value
+        return zlib.decompress(value)
+
+
 class Sentence(BaseModel):
-    """Sentence model."""
+    """
+    Sentence model.
+
+    The xml is left out of the default selections, and fetched when used.
+    Use `load_xml` to fetch it for many sentences at once.
+    """
 
     text = TextField()
-    corpus = CharField(null=True)
+    corpus = CharField(null=True, index=True)
     tense = CharField(null=True)
-    congruent = BooleanField(null=True)    #subtype = CharField(null=True)
+    congruent = BooleanField(null=True, index=True)    #subtype = CharField(null=True)
     type = CharField(null=True)
-    inc_type = CharField(null=True)
+    inc_type = CharField(null=True, index=True)
     auxiliary = BooleanField(null=True)
-    trash = BooleanField(null=True)
+    trash = BooleanField(null=True, index=True)
     undecidable = BooleanField(null=True)
-    verb = CharField(null=True)
+    verb = CharField(null=True, index=True)
     temp_meaning = CharField(null=True)
-    xml = BlobField(null=True)
+    xml = CompressedXMLField(null=True)
     relayed_marker = CharField(null=True)
-    verb_lemma = CharField(null=True)
+    verb_lemma = CharField(null=True, index=True)
+    # derived from the text and xml, see derived.py
+    verb_position = IntegerField(null=True)
+    token_count = IntegerField(null=True)
 
+    @classmethod
+    def select(cls, *fields):
+        if not fields:
+            fields = light_fields()
+        return super().select(*fields)
 
-class NER(BaseModel):
-    """Named entity info."""
-    ex = CharField()
-    type = CharField()
-    subtype = CharField()
-    text = CharField()
-    sentence = ForeignKeyField(Sentence, backref='ner')
+
+def light_fields():
+    """All the fields of Sentence but the xml."""
+    return [field for field in Sentence._meta.sorted_fields if field.name != "xml"]
+
+
+def load_xml(sentences):
+    """Fetch the xml of a list of sentences, with one query per 999 sentences."""
+    missing = [s for s in sentences if "xml" not in s.__data__]
+    for chunk in chunked(missing, 999):
+        query = Sentence.select(Sentence.id, Sentence.xml).where(
+            Sentence.id << [s.id for s in chunk]
+        )
+        xmls = dict(query.tuples())
+        for sentence in chunk:
+            sentence.__data__["xml"] = xmls.get(sentence.id)
+    return sentences
 
 
 class NER(BaseModel):
@@ -66,11 +155,135 @@ class NER(BaseModel):
     subtype = CharField()
     text = CharField()
     sentence = ForeignKeyField(Sentence, backref='ner')
+    # the order of the ne in the sentence
+    position = IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (("sentence", "position"), True),
+            (("ex", "type", "subtype"), False),
+        )
+
+
+class NEStat(BaseModel):
+    """
+    The number of named entities of each kind, per value of a sentence column.
+
+    Kept up to date by triggers on the ner and sentence tables, for the
+    columns in NE_STAT_COLUMNS (see `db.init_ne_stats`). The named entities
+    of a sentence with several verbs are counted once for each of them, by
+    its own values (see NERExtracted).
+    """
+    field = CharField()
+    value = BareField(null=True)
+    ex = CharField(null=True)
+    type = CharField(null=True)
+    subtype = CharField(null=True)
+    count = IntegerField(default=0)
+
+    class Meta:
+        indexes = ((("field", "value", "ex", "type", "subtype"), True),)
+
+
+class NERExtracted(BaseModel):
+    """
+    The sentences whose named entities are in the NER table.
+
+    A sentence with several verbs is stored once per verb, with the same
+    xml. Its named entities are stored once, for the first of them that
+    was extracted (the `source`), and found for the others through the
+    hash of the xml. Sentences without xml have no source.
+    """
+    sentence = ForeignKeyField(Sentence, primary_key=True)
+    source = ForeignKeyField(Sentence, null=True, backref="+")
+    xml_hash = CharField(null=True, index=True)
+
+
+class Token(BaseModel):
+    """
+    One word (<w>) of a sentence, as annotated in the sentence xml.
+
+    The sentence is looked up through the (sentence, position) index, so
+    the foreign key has no index of its own.
+    """
+    sentence = ForeignKeyField(Sentence, backref='tokens', index=False)
+    position = IntegerField()
+    word = CharField(null=True)
+    pos = CharField(null=True)
+    msd = CharField(null=True)
+    lemma = CharField(null=True)
+    ref = CharField(null=True)
+    dephead = CharField(null=True)
+    deprel = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (("sentence", "position"), True),
+            (("sentence", "dephead"), False),
+            (("msd", "deprel"), False),
+            (("pos",), False),
+            (("lemma",), False),
+        )
+
+
+# The attributes of <w> that are kept in the Token table.
+token_attributes = ["pos", "msd", "lemma", "ref", "dephead", "deprel"]
+
+
+class VerbLemma(BaseModel):
+    """The lemmas of the focused verb of a sentence, one row per lemma in Sentence.verb_lemma."""
+    sentence = ForeignKeyField(Sentence, backref='verb_lemmas')
+    lemma = CharField()
+
+    class Meta:
+        indexes = ((("lemma", "sentence"), True),)
+
+
+class AnnotationCheckpoint(BaseModel):
+    """The sentences annotated so far in a run of sparv.annotate_selection."""
+    run = CharField()
+    sentence = ForeignKeyField(Sentence)
+
+    class Meta:
+        indexes = ((("run", "sentence"), True),)
+
+
+class AnnotationFailure(BaseModel):
+    """Sentences that Sparv could not annotate one to one (eg. split in two)."""
+    sentence = ForeignKeyField(Sentence, backref='annotation_failures')
+    reason = CharField()
+
+    class Meta:
+        indexes = ((("sentence", "reason"), True),)
+
+
+class AnnotationCache(BaseModel):
+    """Sentence xml from Sparv, keyed on a hash of the normalized text and the Sparv settings."""
+    key = CharField(primary_key=True)
+    xml = CompressedXMLField()
+
+
+class DerivedState(BaseModel):
+    """The sentences whose derived column (see derived.py) is up to date, and with which version."""
+    column = CharField()
+    sentence = ForeignKeyField(Sentence)
+    version = IntegerField(default=1)
+
+    class Meta:
+        indexes = ((("column", "sentence"), True),)
 
 
 class TodoList(BaseModel):
+    """Named lists of sentences to label, several lists can be in use at once."""
     sent = ForeignKeyField(Sentence, backref='todo')
     checked = BooleanField(default=False)
+    name = CharField(default=DEFAULT_TODO)
+
+    class Meta:
+        indexes = (
+            (("name", "checked", "sent"), False),
+            (("name", "sent"), False),
+        )
 
 
 # TODO use enums or similar to limit value sets?
@@ -119,12 +332,15 @@ def get_field_id(field):
         "xml": Sentence.xml,
         "relayed_marker": Sentence.relayed_marker,
         "verb_lemma": Sentence.verb_lemma,
+        "verb_position": Sentence.verb_position,
+        "token_count": Sentence.token_count,
     }
     return sent[field]
 
 
-def parse_sentence(line, num, parsed_xml, **kwargs):
-    sent = Sentence(
+def sentence_row(line, parsed_xml, **kwargs):
+    """Create the column values of a new sentence, as used by bulk inserts."""
+    return dict(
         text=line,
         corpus=kwargs.get("corpus"),
         tense=kwargs.get("tense"),
@@ -140,4 +356,8 @@ def parse_sentence(line, num, parsed_xml, **kwargs):
         relayed_marker=kwargs.get("relayed_marker"),
         verb_lemma=kwargs.get("verb_lemma"),
         )
+
+
+def parse_sentence(line, num, parsed_xml, **kwargs):
+    sent = Sentence(**sentence_row(line, parsed_xml, **kwargs))
     return sent
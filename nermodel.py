@@ -11,8 +11,28 @@ to make sure everything works as intended).
 > sel = db.find_by_query('id < 100')
 > nermodel.add_ne_info(sel)
 
+or extract the named entities of all sentences that are not done yet
+> nermodel.add_ne_info()
+
+It is safe to run again: sentences that are already extracted are skipped,
+unless they have been annotated again since. Sentences extracted before the
+named entities were shared between verbs (see below) are extracted again.
+
 Explore from gui or ask someone how to do it from Python.
 
+### Counting named entities
+The number of named entities of each kind (ex, type, subtype) per corpus,
+congruency and tense is kept up to date in the nestat table, so these are
+instant:
+> nermodel.ne_stats(by="corpus", ex="TIMEX")
+> nermodel.ne_stats(by="congruent")
+> nermodel.ne_stats()  # all sentences
+
+Other columns, and selections given by a where clause, are counted in sql
+from the ner table:
+> nermodel.ne_stats(by="congruent", where='corpus = "GP"', ex="TIMEX")
+> nermodel.search_ne_info('corpus = "GP" and tense = "past"')
+
 ### Example queries
 - inspecting the ner table:
 SELECT * FROM ner LIMIT 20;
@@ -27,39 +47,175 @@ SELECT ner.subtype, ner.text, sentence.congruent FROM ner
   JOIN sentence on sentence.id = ner.sentence_id where ner.ex = "TIMEX" and sentence.corpus = "GP"
 
 
-NB! Sentences with multiple verbs will have their ne:s multiplied, one time for each verb.
+NB! Sentences with multiple verbs are stored once per verb, but their ne:s are
+only in the table once, for the first of them (see model.NERExtracted). They
+are still counted once per sentence, by its own values. To find the ne:s of
+any of them, join through the nerextracted table:
+
+SELECT ner.* FROM ner JOIN nerextracted ON ner.sentence_id = nerextracted.source_id
+  WHERE nerextracted.sentence_id = 42
 """
+import hashlib
 import lxml.etree as etree
-import datetime
+import multiprocessing
+import time
+import db
 import model
+from peewee import chunked, fn
+from selection import Selection
+
+
+def add_ne_info(selection=None, processes=None, batch_size=model.IMPORT_BATCH):
+    """
+    Extract the named entities of the selected sentences (default all) to the NER table.
+
+    Sentences that are already extracted are skipped. Identical xml (as for
+    sentences with several verbs) is parsed and stored once, also when the
+    sentences are in different batches or runs. The xml is parsed in a pool
+    of `processes` processes (default one per cpu), and each batch of
+    `batch_size` sentences is saved in one transaction.
+    """
+    extracted = model.NERExtracted
+    if selection is None:
+        selection = Selection(model.Sentence.id.not_in(
+            extracted.select(extracted.sentence).where(extracted.xml_hash.is_null(False))
+        ))
+    start = time.time()
+    num = 0
+    with multiprocessing.Pool(processes) as pool:
+        for batch in chunked(selection, batch_size):
+            batch = not_extracted(batch)
+            model.load_xml(batch)
+            # the sentences sharing the same xml
+            by_hash = {}
+            for sentence in batch:
+                if sentence.xml:
+                    xml = bytes(sentence.xml)
+                    by_hash.setdefault(hashlib.sha1(xml).hexdigest(), (xml, []))[1].append(sentence.id)
+            sources = extracted_sources(list(by_hash))
+            new = [key for key in by_hash if key not in sources]
+            rows = []
+            for key, nes in zip(new, pool.imap(extract_nes, [by_hash[key][0] for key in new], chunksize=100)):
+                sources[key] = by_hash[key][1][0]
+                rows.extend(dict(ne, sentence=sources[key]) for ne in nes)
+            done = [
+                dict(sentence=sent_id, source=sources[key], xml_hash=key)
+                for key, (_, ids) in by_hash.items() for sent_id in ids
+            ]
+            done += [dict(sentence=s.id, source=None, xml_hash="") for s in batch if not s.xml]
+            with model.init_sqlite_db.atomic():
+                for part in chunked([sentence.id for sentence in batch], 999):
+                    model.NER.delete().where(model.NER.sentence << part).execute()
+                    extracted.delete().where(extracted.sentence << part).execute()
+                db.bulk_insert(model.NER, rows, ignore=True)
+                db.bulk_insert(extracted, done)
+            num += len(batch)
+            db.print_progress(num, start, "Extracted")
+    print(f"\nExtracted the named entities of {num} sentences")
+
+
+def not_extracted(sentences):
+    """The sentences whose named entities are not extracted yet."""
+    extracted = model.NERExtracted
+    done = set()
+    for part in chunked([s.id for s in sentences], 999):
+        query = extracted.select(extracted.sentence).where(
+            extracted.sentence << part, extracted.xml_hash.is_null(False)
+        )
+        done.update(sent_id for sent_id, in query.tuples())
+    return [s for s in sentences if s.id not in done]
+
+
+def extracted_sources(hashes):
+    """The sentences holding the named entities of already extracted xml, as {xml hash: sentence id}."""
+    extracted = model.NERExtracted
+    sources = {}
+    for part in chunked(hashes, 999):
+        query = extracted.select(extracted.xml_hash, extracted.source).where(
+            extracted.xml_hash << part, extracted.source.is_null(False)
+        )
+        sources.update(query.tuples())
+    return sources
+
+
+def extract_nes(xml):
+    """Get the named entities of a sentence xml. Run by the workers."""
+    nes = []
+    for position, ne_xml in enumerate(etree.fromstring(xml).iterfind(".//ne")):
+        text = [x for x in list(ne_xml.itertext()) if x.strip()]
+        nes.append(dict(
+            text=' '.join(text),
+            position=position,
+            ex=ne_xml.attrib.get('ex') or "",
+            type=ne_xml.attrib.get('type') or "",
+            subtype=ne_xml.attrib.get('subtype') or "",
+        ))
+    return nes
+
+
+def forget(ids):
+    """
+    Mark sentences as not extracted, eg. when their xml has changed.
+
+    The sentences that share their named entities are extracted again too.
+    """
+    extracted = model.NERExtracted
+    for part in chunked(ids, 999):
+        extracted.delete().where((extracted.sentence << part) | (extracted.source << part)).execute()
+
 
+def ne_stats(by=None, where=None, **kinds):
+    """
+    Count the named entities, per kind (ex, type, subtype) and value of the sentence column `by`.
 
-def add_ne_info(selection):
-    for sentence in selection:
-        xml = etree.fromstring(sentence.xml)
-        for ne_xml in xml.iterfind(".//ne"):
-            text = [x for x in list(ne_xml.itertext()) if x.strip()]
-            ner = model.NER(
-                text=' '.join(text),
-                sentence=sentence.id,
-                ex=ne_xml.attrib.get('ex'),
-                type=ne_xml.attrib.get('type'),
-                subtype=ne_xml.attrib.get('subtype'),
-            )
-            ner.save()
+    Return a list of (value, ex, type, subtype, count), most common first
+    (without the value if `by` is None). Restrict the kinds with `ex`, `type`
+    or `subtype`, and the sentences with an sql `where` clause. Counts by the
+    columns in NE_STAT_COLUMNS, over all sentences, are read from the
+    precomputed nestat table, the rest are computed from the ner table.
+    """
+    for key in kinds:
+        if key not in ("ex", "type", "subtype"):
+            raise ValueError(f"Unknown named entity attribute: {key}")
+    stat_columns = model.NE_STAT_COLUMNS
+    if where is None and stat_columns and (by is None or by in stat_columns):
+        stat = model.NEStat
+        # all ne:s are counted for every column
+        field = by or stat_columns[0]
+        columns = [stat.ex, stat.type, stat.subtype]
+        if by is not None:
+            columns.insert(0, stat.value)
+        count = fn.SUM(stat.count)
+        query = stat.select(*columns, count).where(
+            stat.field == field, *[getattr(stat, key) == val for key, val in kinds.items()]
+        )
+    else:
+        ner, extracted = model.NER, model.NERExtracted
+        columns = [ner.ex, ner.type, ner.subtype]
+        if by is not None:
+            columns.insert(0, getattr(model.Sentence, by))
+        count = fn.COUNT(ner.id)
+        # each sentence counts the named entities it shares, by its own values
+        query = (ner.select(*columns, count)
+                 .join(extracted, on=(extracted.source == ner.sentence))
+                 .join(model.Sentence, on=(extracted.sentence == model.Sentence.id)))
+        if where is not None:
+            db.advise_indexes(where)
+            query = query.where(extracted.sentence << Selection(where).ids())
+        for key, val in kinds.items():
+            query = query.where(getattr(ner, key) == val)
+    query = query.group_by(*columns).having(count > 0).order_by(count.desc())
+    if by is None:
+        return list(query.tuples())
+    # the values in nestat are stored as they are in the sentence table
+    python_value = getattr(model.Sentence, by).python_value
+    return [(python_value(value), *rest) for value, *rest in query.tuples()]
 
 
 def search_ne_info(query):
-    q = "select * from sentence where %s;" % query
-    selection = model.Sentence.raw(q)
-    start = datetime.datetime.now()
-    count, fails = 0, 0
-    for sentence in selection:
-        try:
-            xml = etree.fromstring(sentence.xml)
-            for ne_xml in xml.iterfind(".//ne"):
-                count += 1
-        except:
-            fails += 1
-    print(f'Inspected {count} nes, could not parse {fails}')
-    print(f'Took {datetime.datetime.now()-start}')
+    """Print the named entities of the sentences matching an sql where clause, per kind."""
+    stats = ne_stats(where=query)
+    print(f'Found {sum(row[-1] for row in stats)} nes')
+    for ex, type, subtype, count in stats:
+        print(f'{count}\t{ex}\t{type}\t{subtype}')
+    return stats
@@ -0,0 +1,261 @@
+"""
+Search for dependency structures around the focused verb.
+
+A pattern is a dictionary describing a word, as for `db.select_by_xml`,
+with some extra keys for its surroundings:
+
+    children    list of patterns, each matching a different child of the word
+    not         list of patterns, none of the children may match any of them
+    siblings    (only for children) list of patterns that must match other
+                children of the same head, optionally on one "side" ("left" or
+                "right") of the word
+
+All other keys are conditions on the word itself: "word" or any of the
+attributes in the Token table. A condition is either a string, a set (or
+list) of allowed values, or a compiled regular expression that must match
+the whole value.
+
+Usage:
+> import re, db, pattern
+> sel = db.find_by_query('corpus = "familjeliv"')
+> p = pattern.compile_pattern({
+      'children': [{'deprel': 'VG', 'msd': {'VB.SUP.AKT', 'VB.SUP.SFO'},
+                    'children': [{'deprel': 'OO'}]}],
+      'not': [{'deprel': 'SS', 'lemma': re.compile(r'\\|(han|hon)\\|')}],
+  })
+> for sentence in p.search(sel):
+      print(sentence.text)
+
+The pattern is compiled once. Candidate sentences are first narrowed down in sql,
+using the cheap conditions (strings and sets) of all non-negated words, and the
+structure is then checked on the tokens of the remaining sentences.
+"""
+import re
+
+from peewee import chunked, fn
+
+import db
+from model import Sentence, Token, token_attributes
+
+
+STRUCTURE_KEYS = ["children", "not", "siblings", "side"]
+SIDES = ["left", "right"]
+
+
+def compile_pattern(pattern, focus=True):
+    """
+    Compile a pattern.
+
+    If `focus` is true, the top word of the pattern is the focused verb of
+    each sentence, otherwise it may be any word.
+    """
+    return Pattern(Node(pattern, top=True), focus)
+
+
+class Node:
+    """A compiled word pattern."""
+
+    def __init__(self, pattern, top=False):
+        for key in pattern:
+            if key not in STRUCTURE_KEYS and key != "word" and key not in token_attributes:
+                raise ValueError(f"Unknown key in pattern: {key}")
+        if top and ("siblings" in pattern or "side" in pattern):
+            raise ValueError("The top word of a pattern has no siblings")
+        if pattern.get("side") not in SIDES + [None]:
+            raise ValueError(f"side should be one of {SIDES}")
+        self.conditions = {
+            key: val for key, val in pattern.items() if key not in STRUCTURE_KEYS
+        }
+        self.tests = [(key, make_test(val)) for key, val in self.conditions.items()]
+        self.side = pattern.get("side")
+        self.children = [Node(p) for p in pattern.get("children", [])]
+        self.negated = [Node(p) for p in pattern.get("not", [])]
+        self.siblings = [Node(p) for p in pattern.get("siblings", [])]
+
+    def prefilters(self):
+        """Sql conditions on the sentence, for the cheap tests of this node and its required words."""
+        tests = [
+            sql_test(key, val)
+            for key, val in self.conditions.items()
+            if not isinstance(val, re.Pattern)
+        ]
+        filters = []
+        if tests:
+            filters.append(fn.EXISTS(
+                Token.select(Token.id).where(Token.sentence == Sentence.id, *tests)
+            ))
+        for node in self.children + self.siblings:
+            filters.extend(node.prefilters())
+        return filters
+
+    def test(self, token):
+        """Check the conditions on the word itself."""
+        return all(test(getattr(token, key)) for key, test in self.tests)
+
+    def match(self, token, graph):
+        """Check if the word and its surroundings match."""
+        if not self.test(token):
+            return False
+        children = graph.children(token)
+        for node in self.negated:
+            if any(node.match(child, graph) for child in children):
+                return False
+        return assign(self.children, children, graph, set())
+
+
+def assign(nodes, children, graph, used):
+    """Find distinct children for each of the nodes (and their siblings)."""
+    if not nodes:
+        return True
+    node, rest = nodes[0], nodes[1:]
+    for child in children:
+        if child.position in used or not node.match(child, graph):
+            continue
+        siblings = [
+            sibling for sibling in children
+            if sibling.position not in used and sibling.position != child.position
+        ]
+        for sib in node.siblings:
+            if sib.side == "left":
+                sib_children = [s for s in siblings if s.position < child.position]
+            elif sib.side == "right":
+                sib_children = [s for s in siblings if s.position > child.position]
+            else:
+                sib_children = siblings
+            if not any(sib.match(s, graph) for s in sib_children):
+                break
+        else:
+            if assign(rest, children, graph, used | {child.position}):
+                return True
+    return False
+
+
+def make_test(val):
+    """Create a test of an attribute value."""
+    if isinstance(val, re.Pattern):
+        return lambda value: value is not None and val.fullmatch(value) is not None
+    if isinstance(val, (set, frozenset, list, tuple)):
+        values = set(val)
+        return lambda value: value in values
+    return lambda value: value == val
+
+
+def sql_test(key, val):
+    """Create the sql version of a (non-regex) test."""
+    field = getattr(Token, key)
+    if isinstance(val, (set, frozenset, list, tuple)):
+        return field << list(val)
+    return field == val
+
+
+class DepGraph:
+    """The dependency tree of a sentence, built from its tokens."""
+
+    def __init__(self, tokens):
+        self.tokens = sorted(tokens, key=lambda token: token.position)
+        self.by_head = {}
+        for token in self.tokens:
+            self.by_head.setdefault(token.dephead, []).append(token)
+
+    def children(self, token):
+        if token.ref is None:
+            return []
+        return self.by_head.get(token.ref, [])
+
+
+class Pattern:
+    """A compiled pattern, which can be searched for in a selection."""
+
+    def __init__(self, top, focus=True):
+        self.top = top
+        self.focus = focus
+        self.filters = top.prefilters()
+
+    def search(self, sentences=None, batch_size=999):
+        """
+        Yield the sentences that match the pattern, as soon as they are found.
+
+        `sentences` is a selection of sentences, by default all sentences in
+        the data base. Only sentences in the Token table can match.
+        """
+        for sentence, ok in self.scan(sentences, batch_size):
+            if ok:
+                yield sentence
+
+    def split(self, sentences, batch_size=999):
+        """
+        Return the list of matching and of non matching sentences, like `db.select_by_xml`.
+
+        Sentences that the sql prefilter rejects are non matching, as they
+        lack a word that the pattern requires. Sentences that are not in the
+        Token table cannot be checked, and are in neither list.
+        """
+        matches, non_matches = [], []
+        unchecked = 0
+        for sentence, ok in self.scan(sentences, batch_size):
+            if ok is None:
+                unchecked += 1
+            else:
+                (matches if ok else non_matches).append(sentence)
+        print(f"Found {len(matches)} matching sentences")
+        if unchecked:
+            print(f"{unchecked} sentences have no tokens and were not checked (see db.index_tokens)")
+        return matches, non_matches
+
+    def scan(self, sentences=None, batch_size=999):
+        """
+        Yield each candidate sentence with the result of matching it.
+
+        The result is None for sentences that are not in the Token table.
+        """
+        if sentences is None:
+            query = Sentence.select().order_by(Sentence.id)
+            if self.filters:
+                query = query.where(*self.filters)
+            sentences = query.iterator()
+            # already filtered
+            filters = []
+        else:
+            filters = self.filters
+        for chunk in chunked(sentences, batch_size):
+            ids = [sentence.id for sentence in chunk]
+            if filters:
+                ids = [
+                    sent_id for sent_id, in Sentence.select(Sentence.id)
+                    .where(Sentence.id << ids, *filters)
+                    .tuples()
+                ]
+            graphs = self.graphs(ids)
+            # the sentences without a graph either failed the prefilter or have no tokens
+            rejected = [sentence.id for sentence in chunk if sentence.id not in graphs]
+            indexed = self.indexed(rejected) if filters else set()
+            for sentence in chunk:
+                graph = graphs.get(sentence.id)
+                if graph is None:
+                    yield sentence, False if sentence.id in indexed else None
+                else:
+                    yield sentence, self.match(sentence, graph)
+
+    def match(self, sentence, graph):
+        """Check one sentence."""
+        if self.focus:
+            position = db.verb_position(sentence.text)
+            if position >= len(graph.tokens):
+                return False
+            return self.top.match(graph.tokens[position], graph)
+        return any(self.top.match(token, graph) for token in graph.tokens)
+
+    def indexed(self, ids):
+        """The ids of the sentences that are in the Token table."""
+        indexed = set()
+        for part in chunked(ids, 999):
+            query = Token.select(Token.sentence).where(Token.sentence << part).distinct()
+            indexed.update(sent_id for sent_id, in query.tuples())
+        return indexed
+
+    def graphs(self, ids):
+        """Build the dependency graphs of some sentences."""
+        tokens = {}
+        for token in Token.select().where(Token.sentence << ids).namedtuples():
+            tokens.setdefault(token.sentence, []).append(token)
+        return {sent_id: DepGraph(words) for sent_id, words in tokens.items()}
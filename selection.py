@@ -0,0 +1,198 @@
+"""Selections of sentences that are read from the data base page by page."""
+import re
+
+from peewee import SQL, chunked
+
+from model import DEFAULT_TODO, PAGE_SIZE, Sentence, TodoList, init_sqlite_db, light_fields
+
+
+class Selection:
+    """
+    A selection of sentences, given by a where clause.
+
+    The where clause is either an sql string, as for `db.find_by_query`, or a
+    peewee expression. Only the number of sentences is computed up front
+    (with count(*)). Iterating reads `page_size` rows at a time, ordered by id
+    and continuing from the last seen id, so the memory use does not depend
+    on the size of the selection.
+    """
+
+    # the column that orders the pages
+    key = Sentence.id
+
+    def __init__(self, where=None, page_size=PAGE_SIZE, fields=None):
+        if isinstance(where, str):
+            check_where(where)
+        self.where = where
+        self.page_size = page_size
+        self.fields = fields or light_fields()
+        self._count = None
+
+    def __repr__(self):
+        return f"<Selection {self.where}>"
+
+    def condition(self):
+        """The where clause as a peewee expression."""
+        if isinstance(self.where, str):
+            # in a query of its own, so that the clause can refer to the table as "sentence"
+            return Sentence.id.in_(SQL(f'(SELECT "id" FROM "sentence" WHERE {self.where})'))
+        return self.where
+
+    def query(self, *fields):
+        """A peewee query for the selected sentences."""
+        query = Sentence.select(*(fields or self.fields))
+        if self.where is not None:
+            query = query.where(self.condition())
+        return query
+
+    def ids(self):
+        """A query for the ids of the selected sentences, to use as a subquery."""
+        return self.query(Sentence.id)
+
+    def count(self):
+        """Count the sentences (again)."""
+        self._count = self.ids().count()
+        return self._count
+
+    def __len__(self):
+        # counted again after each page, as labeling changes the selection
+        if self._count is None:
+            self.count()
+        return self._count
+
+    def __bool__(self):
+        return self.ids().exists()
+
+    def pages(self):
+        """Yield the sentences as lists of (at most) `page_size` sentences."""
+        last = None
+        while True:
+            query = self.query().order_by(self.key).limit(self.page_size)
+            if last is not None:
+                query = query.where(self.key > last)
+            page = list(query)
+            self._count = None
+            if not page:
+                return
+            yield page
+            last = page[-1].id
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+    def __getitem__(self, index):
+        query = self.query().order_by(self.key)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 1:
+                raise ValueError("Selections can only be sliced forwards")
+            return list(query.offset(start).limit(max(stop - start, 0)))[::step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Selection index out of range")
+        # not .get(), which resets the offset
+        return list(query.offset(index).limit(1))[0]
+
+    def get_by_id(self, sent_id):
+        """Get a fresh version of one of the selected sentences."""
+        return self.query().where(Sentence.id == sent_id).get()
+
+    def refresh(self, sentences):
+        """Get fresh versions of a list of sentences, in the same order."""
+        fresh = {}
+        for chunk in chunked([s.id for s in sentences], 999):
+            for sentence in Sentence.select(*self.fields).where(Sentence.id << chunk):
+                fresh[sentence.id] = sentence
+        return [fresh[s.id] for s in sentences if s.id in fresh]
+
+
+# Clauses that cannot be part of a where clause, as the selection orders and pages the rows.
+NOT_WHERE = re.compile(r"\b(order\s+by|group\s+by|limit|offset)\b", re.I)
+STRING = re.compile(r"'[^']*'|\"[^\"]*\"")
+
+
+def check_where(where):
+    """Raise a ValueError for a where clause that ends in order by, limit etc."""
+    m = NOT_WHERE.search(STRING.sub("''", where))
+    if m:
+        raise ValueError(
+            f"Selections are read in id order and page by page, remove '{m.group()} ...' "
+            f"from the where clause: {where!r}"
+        )
+
+
+class TodoSelection(Selection):
+    """The sentences that are not yet checked in a todo list."""
+
+    # same order as Sentence.id, but lets sqlite walk the todo list index
+    key = TodoList.sent
+
+    def __init__(self, todo=DEFAULT_TODO, page_size=PAGE_SIZE, fields=None):
+        super().__init__(page_size=page_size, fields=fields)
+        self.todo = todo
+
+    def __repr__(self):
+        return f"<TodoSelection {self.todo}>"
+
+    def query(self, *fields):
+        return (
+            Sentence.select(*(fields or self.fields))
+            .join(TodoList, on=(TodoList.sent == Sentence.id))
+            .where(TodoList.name == self.todo, TodoList.checked == False)
+        )
+
+
+class SearchSelection(Selection):
+    """
+    The sentences matching a full text search (see `db.search`), best matches first.
+
+    The ids of the matching sentences are looked up once, in rank order,
+    and the sentences are read page by page.
+    """
+
+    def __init__(self, match, limit=None, page_size=PAGE_SIZE, fields=None):
+        ranked = SQL(
+            "(SELECT rowid FROM sentence_fts WHERE sentence_fts MATCH ? ORDER BY rank LIMIT ?)",
+            [match, limit or -1],
+        )
+        super().__init__(Sentence.id << ranked, page_size=page_size, fields=fields)
+        self.match = match
+        self.limit = limit
+        self._ids = None
+
+    def __repr__(self):
+        return f"<SearchSelection {self.match}>"
+
+    def ranked_ids(self):
+        """The ids of the matching sentences, best first."""
+        if self._ids is None:
+            cursor = init_sqlite_db.execute_sql(
+                "SELECT rowid FROM sentence_fts WHERE sentence_fts MATCH ? ORDER BY rank LIMIT ?",
+                (self.match, self.limit or -1),
+            )
+            self._ids = [sent_id for sent_id, in cursor]
+        return self._ids
+
+    def count(self):
+        self._ids = None
+        self._count = len(self.ranked_ids())
+        return self._count
+
+    def pages(self):
+        for ids in chunked(self.ranked_ids(), self.page_size):
+            yield self.fetch(ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.fetch(self.ranked_ids()[index])
+        return self.fetch([self.ranked_ids()[index]])[0]
+
+    def fetch(self, ids):
+        """Read sentences by id, in the order of the ids."""
+        sentences = {}
+        for chunk in chunked(ids, 999):
+            for sentence in Sentence.select(*self.fields).where(Sentence.id << chunk):
+                sentences[sentence.id] = sentence
+        return [sentences[sent_id] for sent_id in ids if sent_id in sentences]
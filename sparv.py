@@ -1,9 +1,35 @@
 import db
+import nermodel
+from model import AnnotationCache, AnnotationCheckpoint, AnnotationFailure, init_sqlite_db
 
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
 import xml.etree.ElementTree as ET
-import re
 import urllib.parse
-import urllib.request
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from peewee import chunked
+
+
+# The Sparv web service, can be pointed to another (eg. a local test) server.
+SPARV_URL = os.environ.get("SPARV_URL", "https://ws.spraakbanken.gu.se/ws/sparv/v2/")
+# Number of requests sent to Sparv at the same time.
+IN_FLIGHT = 4
+# Characters of text per request. The size is adapted so that a request
+# takes about TARGET_LATENCY seconds, within the limits.
+CHUNK_CHARS = 50000
+MIN_CHUNK_CHARS = 2000
+MAX_CHUNK_CHARS = 1000000
+TARGET_LATENCY = 30.0
+# Failed requests are retried, waiting BACKOFF, 2*BACKOFF, 4*BACKOFF... seconds.
+RETRIES = 5
+BACKOFF = 1.0
+TIMEOUT = 600
+# Bytes read from the answer at a time.
+READ_SIZE = 1 << 16
 
 
 settings =  {      "textmode": "plain",
@@ -37,34 +63,320 @@ settings =  {      "textmode": "plain",
     }
 }
 
+class SparvError(Exception):
+    """Sparv answered with an error."""
+
+
 def annotate(sents):
-    """Get annotations for a sentence."""
+    """
+    Get annotations for a sentence.
+
+    Only sentences whose text is not in the annotation cache are sent to Sparv.
+    """
+    keys, found, misses = lookup(sents)
+    if misses:
+        xml, failures, _ = fetch(misses)
+        found.update(remember(misses, xml))
+        record_failures(share_failures(sents, keys, failures))
+    xml = [found.get(key) for key in keys]
+    store(sents, xml)
+    return xml
+
+
+def fetch(sents):
+    """
+    Get the xml of sentences from Sparv, one (possibly None) per sentence.
+
+    If Sparv does not find the same number of sentences, the sentences are
+    split in halves and sent again, until the sentences it fails on are
+    isolated. Those get no xml, and are returned as failures (sentence,
+    reason). Also return the time it took.
+    """
+    start = time.time()
+    failures = []
+    def bisect(sents):
+        xml = request(sents)
+        if len(xml) == len(sents):
+            return xml
+        if len(sents) == 1:
+            failures.append((sents[0], f"Sparv found {len(xml)} sentences"))
+            return [None]
+        half = len(sents) // 2
+        return bisect(sents[:half]) + bisect(sents[half:])
+    xml = bisect(sents)
+    return xml, failures, time.time() - start
+
+
+def record_failures(failures):
+    """Save the sentences that could not be annotated."""
+    if failures:
+        print(f"Sparv miscounted sentences. Disgarding id {[s.id for s, _ in failures]}")
+        db.bulk_insert(AnnotationFailure, [
+            dict(sentence=sentence.id, reason=reason) for sentence, reason in failures
+        ], ignore=True)
+
+
+def share_failures(sents, keys, failures):
+    """
+    The failures of all the sentences, given those of the sentences sent to Sparv
+    (one per text): a sentence fails if a sentence with the same text did.
+    """
+    reasons = {cache_key(s.text): reason for s, reason in failures}
+    return [(s, reasons[key]) for s, key in zip(sents, keys) if key in reasons]
+
+
+def recorded_failures():
+    """The ids of the sentences that Sparv has failed on before."""
+    query = AnnotationFailure.select(AnnotationFailure.sentence).distinct()
+    return {sent_id for sent_id, in query.tuples()}
+
+
+def cache_key(text):
+    """Hash of the normalized text of a sentence and of the Sparv settings."""
+    normalized = " ".join(text.split())
+    key = json.dumps(settings, sort_keys=True) + "\n" + normalized
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def lookup(sents):
+    """
+    Look up sentences in the annotation cache.
+
+    Return the cache key of each sentence, the cached xml by key, and the
+    sentences that need to be sent to Sparv (one per distinct text).
+    """
+    keys = [cache_key(s.text) for s in sents]
+    found = {}
+    for part in chunked(list(set(keys)), 999):
+        query = AnnotationCache.select().where(AnnotationCache.key << part)
+        found.update((entry.key, entry.xml) for entry in query)
+    misses = {}
+    for key, sentence in zip(keys, sents):
+        if key not in found and key not in misses:
+            misses[key] = sentence
+    return keys, found, list(misses.values())
+
+
+def remember(sents, xml):
+    """Add the xml of sentences (where there is one) to the cache. Return the new xml by key."""
+    entries = {cache_key(s.text): sxml for s, sxml in zip(sents, xml) if sxml is not None}
+    with init_sqlite_db.atomic():
+        for part in chunked(list(entries.items()), 400):
+            AnnotationCache.insert_many(part, fields=[AnnotationCache.key, AnnotationCache.xml]).on_conflict_replace().execute()
+    return entries
+
 
+def request(sents):
+    """Send sentences to Sparv, retrying on failure, and return the xml of each sentence."""
     urlsettings = str(settings).replace("'",'"').replace(' ','')
     data = {'text': '\n\n'.join([s.text for s in sents])}
     data = urllib.parse.urlencode(data).encode('utf-8')
-    url = f'https://ws.spraakbanken.gu.se/ws/sparv/v2/?settings={urlsettings}'
-    req =urllib.request.Request(url, data)
-    with urllib.request.urlopen(req) as response:
-        ans = response.read()
-    tree = ET.fromstring(ans)
-    xml = [ET.tostring(x) for x in tree.findall('.//sentence')]
-    if len(xml) != len(sents):
-        print(f"Something went wrong! Sparv miscounted sentences. Disgarding id {[s.id for s in sents]}")
-    for sxml, sentence in zip(xml, sents):
-        db.Sentence.update({db.Sentence.xml: sxml}).where(
-            db.Sentence.id == sentence.id
-        ).execute()
+    url = urllib.parse.urlsplit(SPARV_URL)
+    path = f"{url.path or '/'}?settings={urllib.parse.quote(urlsettings)}"
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    for attempt in range(RETRIES + 1):
+        try:
+            conn = connection(url)
+            conn.request("POST", path, data, headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                response.read()
+                raise SparvError(f"Sparv answered {response.status} {response.reason}")
+            return parse(response)
+        except (OSError, http.client.HTTPException, ET.ParseError, SparvError) as err:
+            close_connection()
+            if attempt == RETRIES:
+                raise
+            db.log(f"Sparv request failed ({err}), retrying")
+            time.sleep(BACKOFF * 2 ** attempt)
+
+
+_local = threading.local()
+
+
+def connection(url):
+    """A persistent connection to Sparv, one per thread."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "netloc", None) != url.netloc:
+        close_connection()
+        if url.scheme == "https":
+            conn = http.client.HTTPSConnection(url.netloc, timeout=TIMEOUT)
+        else:
+            conn = http.client.HTTPConnection(url.netloc, timeout=TIMEOUT)
+        _local.conn, _local.netloc = conn, url.netloc
+    return conn
+
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def parse(answer):
+    """
+    Get the xml of each sentence in an answer from Sparv.
+
+    The answer (a file like object) is parsed while it is read, and each
+    sentence is serialized and dropped from the tree as soon as it is complete.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    parents, xml = [], []
+    for block in iter(lambda: answer.read(READ_SIZE), b""):
+        parser.feed(block)
+        for event, elem in parser.read_events():
+            if event == "start":
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag == "sentence":
+                xml.append(ET.tostring(elem))
+                if parents:
+                    parents[-1].remove(elem)
+    parser.close()
     return xml
 
 
-def annotate_selection(selection):
-    done = 0
-    print_progressbar(done, len(selection))
-    for sents in chunk(selection, 500):
-        annotate(sents)
-        done += len(sents)
-        print_progressbar(done, len(selection))
+def store(sents, xml):
+    """Save the xml of the sentences (where there is one), in one transaction."""
+    annotated = [(sentence.id, sxml) for sxml, sentence in zip(xml, sents) if sxml is not None]
+    rows = [(db.Sentence.xml.db_value(sxml), sent_id) for sent_id, sxml in annotated]
+    with init_sqlite_db.atomic():
+        init_sqlite_db.cursor().executemany('UPDATE "sentence" SET "xml" = ? WHERE "id" = ?', rows)
+        db.update_tokens(annotated)
+        nermodel.forget([sent_id for sent_id, _ in annotated])
+    return [sentence for sxml, sentence in zip(xml, sents) if sxml is not None]
+
+
+def annotate_selection(selection, run="default", in_flight=IN_FLIGHT, chunk_size=None,
+                       retry_failures=False):
+    """
+    Annotate a selection of sentences, sending `in_flight` requests at a time.
+
+    The annotated sentences are recorded under the name `run`, so that an
+    interrupted run continues where it stopped when started again. The
+    record is cleared when all sentences have been annotated.
+    Sentences found in the annotation cache are not sent to Sparv.
+    The requests are sized by the length of the texts, adapted to how long
+    Sparv takes to answer, unless a fixed number of sentences (`chunk_size`)
+    is given. Sentences that Sparv miscounts are saved in the
+    AnnotationFailure table, and left as they are. They are skipped by later
+    runs, unless `retry_failures` is set.
+    """
+    total = len(selection)
+    finished = checkpointed(run)
+    skipped = set() if retry_failures else recorded_failures() - finished
+    done, skips = 0, 0
+    if finished or skipped:
+        for s in selection:
+            done += s.id in finished
+            skips += s.id in skipped
+    if skips:
+        print(f"Skipping {skips} sentences that Sparv has failed on before.")
+    finished |= skipped
+    done += skips
+    failed, miscounted = 0, 0
+    print_progressbar(done, total)
+    todo = (s for s in selection if s.id not in finished)
+    sizer = ChunkSizer()
+    with ThreadPoolExecutor(in_flight) as pool:
+        pending = {}
+        def finish(sents, keys, found, failures=()):
+            nonlocal done, failed, miscounted
+            xml = [found.get(key) for key in keys]
+            # all the sentences with the text of a miscounted one are miscounted
+            failures = share_failures(sents, keys, failures)
+            with init_sqlite_db.atomic():
+                stored = store(sents, xml)
+                record_failures(failures)
+                # the miscounted sentences are recorded as failures, don't retry them
+                bad = {s.id for s, _ in failures}
+                checkpoint(run, stored + [s for s in sents if s.id in bad])
+            done += len(stored)
+            miscounted += len(bad)
+            failed += len(sents) - len(stored) - len(bad)
+            print_progressbar(done + miscounted, total)
+
+        def collect(return_when):
+            ready, _ = wait(pending, return_when=return_when)
+            for future in ready:
+                sents, keys, found, misses = pending.pop(future)
+                failures = []
+                try:
+                    xml, failures, seconds = future.result()
+                    found.update(remember(misses, xml))
+                    sizer.observe(sum(len(s.text) for s in misses), seconds)
+                except Exception as err:
+                    db.log(f"Could not annotate {[s.id for s in misses]}: {err}")
+                finish(sents, keys, found, failures)
+
+        if chunk_size:
+            chunks = chunk(todo, chunk_size)
+        else:
+            chunks = sizer.chunks(todo)
+        for sents in chunks:
+            keys, found, misses = lookup(sents)
+            if not misses:
+                finish(sents, keys, found)
+                continue
+            if len(pending) >= in_flight:
+                collect(FIRST_COMPLETED)
+            pending[pool.submit(fetch, misses)] = (sents, keys, found, misses)
+        while pending:
+            collect(FIRST_COMPLETED)
+    if miscounted:
+        print(f"Sparv miscounted {miscounted} sentences, see the AnnotationFailure table.")
+    if failed:
+        print(f"Could not annotate {failed} sentences, run again to retry them.")
+    else:
+        AnnotationCheckpoint.delete().where(AnnotationCheckpoint.run == run).execute()
+
+
+class ChunkSizer:
+    """
+    Decide how much text to send in each request.
+
+    Starts with CHUNK_CHARS characters, and moves towards the amount that
+    Sparv is observed to annotate in TARGET_LATENCY seconds.
+    """
+
+    def __init__(self, chars=CHUNK_CHARS, latency=TARGET_LATENCY):
+        self.chars = chars
+        self.latency = latency
+
+    def observe(self, chars, seconds):
+        """Take the time of an answer into account."""
+        if chars and seconds > 0:
+            wanted = chars * self.latency / seconds
+            # move half way, to smooth out single slow answers
+            chars = (self.chars + wanted) / 2
+            self.chars = int(min(MAX_CHUNK_CHARS, max(MIN_CHUNK_CHARS, chars)))
+
+    def chunks(self, sentences):
+        """Group sentences into chunks of about `self.chars` characters."""
+        current, size = [], 0
+        for sentence in sentences:
+            current.append(sentence)
+            size += len(sentence.text)
+            if size >= self.chars:
+                yield current
+                current, size = [], 0
+        if current:
+            yield current
+
+
+def checkpointed(run):
+    """The ids of the sentences annotated so far in a run."""
+    query = AnnotationCheckpoint.select(AnnotationCheckpoint.sentence).where(
+        AnnotationCheckpoint.run == run
+    )
+    return {sent_id for sent_id, in query.tuples()}
+
+
+def checkpoint(run, sents):
+    """Record that sentences have been annotated in a run."""
+    db.bulk_insert(AnnotationCheckpoint, [dict(run=run, sentence=s.id) for s in sents])
 
 
 # Print iterations progress
@@ -87,6 +399,5 @@ def print_progressbar(iteration, total, decimals=1, length=100):
         print()
 
 
-def chunk(list, size):
-    for i in range(0, len(list), size):
-        yield list[i: i+size]
+def chunk(sentences, size):
+    yield from chunked(sentences, size)
@@ -1,49 +1,106 @@
 import db
+import derived
 import pdb
-from sparv import annotate
-from model import Sentence
+import sparv
+import time
+from model import NER, Sentence, TodoList, VerbLemma, init_sqlite_db, light_fields
+from peewee import chunked, fn
 
+# Columns that are not copied to the new sentence: the text is split, and
+# the rest is computed again from the new text and xml (see derived.py).
+NOT_COPIED = ["id", "text", "xml", "verb_position", "token_count"]
 
-def split_sentence(sentence):
+
+def split_sentence(sentence, annotate=False):
     """Separate the text part of sentences, as annotated with '&&&'"""
-    s_id = sentence.split()[0]
-    sentence = sentence.split(maxsplit=1)[1].strip().strip('\n')
-    text1, text2 = sentence.split("&&&", 1)
-    # get the sentence from the db
-    info = Sentence().get_by_id(s_id)
-    # Create a new sentence
-    newsent = Sentence(
-        text=text2,
-        corpus=info.corpus,
-        tense=info.tense,
-        congruent=info.congruent,
-        inc_type=info.inc_type,
-        type=info.type,
-        trash=info.trash,
-        compound_tense=info.compound_tense,
-        undecidable=info.undecidable,
-        verb=info.verb,
-        temp_meaning=info.temp_meaning,
-        relayed_marker=info.relayed_marker,
-    )
-    newsent.save()
-    print("Added", newsent.id)
-    # Update text of the original sentence (remove second part)
-    db.Sentence.update({db.Sentence.text: text1}).where(
-        db.Sentence.id == s_id
-    ).execute()
     # Return the old and the new sentence
-    return [info, newsent]
+    return split_lines([sentence], annotate)
 
 
-def split_many(filepath):
+def split_many(filepath, annotate=True):
     """Split a list of sentences. Each row of the file should look like
        <id>  sentence part 1&&&sentence part 2.
+
+    All sentences are split in one transaction, so either all or none of
+    them are. The halves are then annotated by Sparv (see
+    `sparv.annotate_selection`).
     """
-    updated = []
-    for line in open(filepath):
-        updated.extend(split_sentence(line))
-    # Update the xml of both sentences
-    annotate(updated)
+    with open(filepath) as fh:
+        updated = split_lines([line for line in fh if line.strip()], annotate)
     # Return all ids
     return [s.id for s in updated]
+
+
+def parse_line(line):
+    """Get the id and the two halves of a line of a split file."""
+    s_id, sentence = line.split(maxsplit=1)
+    text1, text2 = sentence.strip().strip('\n').split("&&&", 1)
+    return int(s_id), text1, text2
+
+
+def split_lines(lines, annotate=True):
+    """
+    Split the sentences of some lines (as in `split_many`).
+
+    The new sentence gets the column values, named entities, todo list
+    entries and verb lemmas of the original. Return the original and the
+    new sentences.
+    """
+    splits = {}
+    for num, line in enumerate(lines, 1):
+        try:
+            s_id, text1, text2 = parse_line(line)
+        except ValueError:
+            raise ValueError(f"Bad line {num}, should be <id> part 1&&&part 2: {line!r}")
+        if s_id in splits:
+            raise ValueError(f"Sentence {s_id} is split twice (line {num})")
+        splits[s_id] = (text1, text2)
+    # get the sentences from the db
+    originals = {}
+    for ids in chunked(list(splits), 999):
+        for sentence in Sentence.select().where(Sentence.id << ids):
+            originals[sentence.id] = sentence
+    missing = [s_id for s_id in splits if s_id not in originals]
+    if missing:
+        raise ValueError(f"Sentences not found: {missing}")
+    copied = [field for field in light_fields() if field.name not in NOT_COPIED]
+    with init_sqlite_db.atomic():
+        first = (Sentence.select(fn.MAX(Sentence.id)).scalar() or 0) + 1
+        new_ids = dict(zip(splits, range(first, first + len(splits))))
+        rows = []
+        for s_id, (text1, text2) in splits.items():
+            row = {field.name: getattr(originals[s_id], field.name) for field in copied}
+            rows.append(dict(row, id=new_ids[s_id], text=text2))
+        db.bulk_insert(Sentence, rows)
+        # Update text of the original sentences (remove second part)
+        init_sqlite_db.cursor().executemany(
+            'UPDATE "sentence" SET "text" = ? WHERE "id" = ?',
+            [(text1, s_id) for s_id, (text1, _) in splits.items()],
+        )
+        copy_rows(NER, NER.sentence, new_ids, exclude=["id"])
+        copy_rows(TodoList, TodoList.sent, new_ids, exclude=["id"])
+        copy_rows(VerbLemma, VerbLemma.sentence, new_ids, exclude=["id"])
+        # the copied verb lemmas are computed again, from the new text
+        derived.outdate(list(new_ids.values()))
+    print(f"Split {len(splits)} sentences, added {first} to {first + len(splits) - 1}")
+    updated = []
+    for ids in chunked(list(splits) + list(new_ids.values()), 999):
+        updated.extend(Sentence.select().where(Sentence.id << ids).order_by(Sentence.id))
+    if annotate:
+        # Update the xml of both halves, in a run of their own, so that an
+        # earlier run that failed does not count them as done
+        run = f"split-{first}-{int(time.time())}"
+        print(f"Annotating the halves (run {run!r}, give it to sparv.annotate_selection to retry)")
+        sparv.annotate_selection(updated, run=run)
+    return updated
+
+
+def copy_rows(table, key, new_ids, exclude=()):
+    """Copy the rows of `table` that refer to the original sentences to the new ones."""
+    fields = [field for field in table._meta.sorted_fields if field.name not in exclude]
+    rows = []
+    for ids in chunked(list(new_ids), 999):
+        for row in table.select(*fields).where(key << ids).dicts():
+            row[key.name] = new_ids[row[key.name]]
+            rows.append(row)
+    db.bulk_insert(table, rows)